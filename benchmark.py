@@ -0,0 +1,210 @@
+#!/usr/local/miniconda/bin/python
+# Measures the overhead of run.py itself (BIDS indexing, metadata and fieldmap
+# resolution, NIfTI header reads, command construction) on synthetic datasets.
+# The HCP Pipelines scripts are replaced by stubs, so neither FSL nor
+# FreeSurfer is needed, e.g.:
+#   benchmark.py /tmp/bench --subjects 10 100 1000 --output bench.json
+#   benchmark.py /tmp/bench --baseline bench.json
+import argparse
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import nibabel
+from collections import OrderedDict
+from pathlib import Path
+
+run_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")
+
+stub_scripts = ["PreFreeSurfer/PreFreeSurferPipeline.sh",
+                "FreeSurfer/FreeSurferPipeline.sh",
+                "PostFreeSurfer/PostFreeSurferPipeline.sh",
+                "fMRIVolume/GenericfMRIVolumeProcessingPipeline.sh",
+                "fMRISurface/GenericfMRISurfaceProcessingPipeline.sh",
+                "DiffusionPreprocessing/DiffPreprocPipeline.sh",
+                "DiffusionPreprocessing/DiffPreprocPipeline_PreEddy.sh",
+                "DiffusionPreprocessing/DiffPreprocPipeline_Eddy.sh",
+                "DiffusionPreprocessing/DiffPreprocPipeline_PostEddy.sh"]
+
+all_stages = ["PreFreeSurfer", "FreeSurfer", "PostFreeSurfer", "fMRIVolume", "fMRISurface",
+              "DiffusionPreprocessing_PreEddy", "DiffusionPreprocessing_Eddy",
+              "DiffusionPreprocessing_PostEddy"]
+
+# timings compared against a baseline, with the fraction they may grow by
+regression_metrics = ["startup_s", "plan_per_subject_s", "export_per_subject_s",
+                      "single_subject_plan_s", "single_subject_run_s"]
+
+def nifti_bytes(shape, zooms):
+    # the images only need a valid header, one gzipped image is reused for
+    # every file of the same kind
+    image = nibabel.Nifti1Image(np.zeros(shape, dtype=np.int16), np.eye(4))
+    image.header.set_zooms(zooms)
+    return gzip.compress(image.to_bytes(), compresslevel=1)
+
+def write_json(path, content):
+    with open(path, "w") as fp:
+        json.dump(content, fp)
+
+def make_dataset(bids_dir, n_subjects, n_sessions, n_bolds):
+    images = {"anat": nifti_bytes((4, 4, 4), (0.8, 0.8, 0.8)),
+              "bold": nifti_bytes((4, 4, 4, 5), (2, 2, 2, 0.8)),
+              "epi": nifti_bytes((4, 4, 4, 3), (2, 2, 2, 1)),
+              "dwi": nifti_bytes((4, 4, 4, 3), (1.5, 1.5, 1.5, 1))}
+    Path(bids_dir).mkdir(parents=True, exist_ok=True)
+    write_json(os.path.join(bids_dir, "dataset_description.json"),
+               {"Name": "run.py benchmark", "BIDSVersion": "1.4.0"})
+    for s in range(1, n_subjects + 1):
+        subject = "sub-%05d"%s
+        for session in ["ses-%d"%i for i in range(1, n_sessions + 1)] or [None]:
+            prefix = subject if session is None else f"{subject}_{session}"
+            session_dir = os.path.join(bids_dir, subject, session or "")
+            relative_dir = session + "/" if session else ""
+            for datatype in ["anat", "func", "fmap", "dwi"]:
+                Path(os.path.join(session_dir, datatype)).mkdir(parents=True, exist_ok=True)
+
+            def image(datatype, name, kind, metadata):
+                path = os.path.join(session_dir, datatype, f"{prefix}_{name}.nii.gz")
+                with open(path, "wb") as fp:
+                    fp.write(images[kind])
+                write_json(path[:-len(".nii.gz")] + ".json", metadata)
+                return f"{relative_dir}{datatype}/{prefix}_{name}.nii.gz"
+
+            intended_for = [image("anat", "T1w", "anat", {"DwellTime": 7.4e-06})]
+            image("anat", "T2w", "anat", {"DwellTime": 2.1e-06})
+            for run in range(1, n_bolds + 1):
+                intended_for.append(image("func", f"task-rest_run-{run}_bold", "bold",
+                                          {"EffectiveEchoSpacing": 0.00058, "PhaseEncodingDirection": "j-",
+                                           "RepetitionTime": 0.8, "SliceTiming": [0, 0.2, 0.4, 0.6],
+                                           "TaskName": "rest"}))
+            for direction, pe in [("AP", "j-"), ("PA", "j")]:
+                image("fmap", f"dir-{direction}_epi", "epi",
+                      {"EffectiveEchoSpacing": 0.00058, "PhaseEncodingDirection": pe,
+                       "TotalReadoutTime": 0.05, "IntendedFor": intended_for})
+                dwi = image("dwi", f"dir-{direction}_dwi", "dwi",
+                            {"EffectiveEchoSpacing": 0.00069, "PhaseEncodingDirection": pe})
+                stem = os.path.join(bids_dir, subject, dwi[:-len(".nii.gz")])
+                with open(stem + ".bval", "w") as fp:
+                    fp.write("0 1000 1000\n")
+                with open(stem + ".bvec", "w") as fp:
+                    fp.write("0 1 0\n0 0 1\n0 0 0\n")
+
+def make_stub_environment(stub_dir):
+    # HCP Pipelines and FreeSurfer directories just complete enough for run.py
+    env = dict(os.environ)
+    env.update({"HCPPIPEDIR": os.path.join(stub_dir, "hcp"),
+                "HCPPIPEDIR_Templates": os.path.join(stub_dir, "hcp", "global", "templates"),
+                "HCPPIPEDIR_Config": os.path.join(stub_dir, "hcp", "global", "config"),
+                "SUBJECTS_DIR": os.path.join(stub_dir, "freesurfer", "subjects"),
+                "PATH": os.path.join(stub_dir, "bin") + os.pathsep + os.environ.get("PATH", "")})
+    for script in stub_scripts + ["../bin/fslmerge"]:
+        path = os.path.normpath(os.path.join(env["HCPPIPEDIR"], script))
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write("#!/bin/sh\nexit 0\n")
+        os.chmod(path, 0o755)
+    for template in ["fsaverage", "lh.EC_average", "rh.EC_average"]:
+        Path(os.path.join(env["SUBJECTS_DIR"], template)).mkdir(parents=True, exist_ok=True)
+    return env
+
+def timed_run(arguments, env):
+    # wall time and peak memory of one run.py invocation
+    start = time.time()
+    process = subprocess.Popen([sys.executable, run_py] + arguments, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_s = time.time() - start
+    if os.WEXITSTATUS(status) != 0:
+        print(output.decode(errors="replace")[-4000:])
+        raise Exception("run.py %s failed"%" ".join(arguments))
+    return wall_s, rusage.ru_maxrss / 1024.0
+
+def benchmark_size(work_dir, n_subjects, env, bench_args):
+    bids_dir = os.path.join(work_dir, f"bids_{n_subjects}")
+    output_dir = os.path.join(work_dir, f"output_{n_subjects}")
+    result = OrderedDict([("n_subjects", n_subjects),
+                          ("n_sessions", bench_args.sessions),
+                          ("n_bolds", bench_args.bolds)])
+    if not os.path.isdir(bids_dir):
+        start = time.time()
+        make_dataset(bids_dir, n_subjects, bench_args.sessions, bench_args.bolds)
+        result["generate_s"] = time.time() - start
+    first_subject = sorted(d for d in os.listdir(bids_dir) if d.startswith("sub-"))[0]
+
+    common = [bids_dir, output_dir, "participant", "--skip_bids_validation",
+              "--license_key", "benchmark", "--stages"] + all_stages
+    for stale_dir in ["plans", "jobs", "checkpoints", "logs", "profiling", "tmp"]:
+        shutil.rmtree(os.path.join(output_dir, stale_dir), ignore_errors=True)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    # interpreter start, imports and argument parsing
+    result["startup_s"], result["startup_max_rss_mb"] = timed_run(["--version"], env)
+    # indexing the whole dataset and planning every participant
+    wall_s, result["plan_max_rss_mb"] = timed_run(common + ["--plan_only"], env)
+    result["plan_s"] = wall_s
+    result["plan_per_subject_s"] = (wall_s - result["startup_s"]) / n_subjects
+    # the same plus constructing the command of every stage
+    wall_s, result["export_max_rss_mb"] = timed_run(common + ["--export_jobs"], env)
+    result["export_s"] = wall_s
+    result["export_per_subject_s"] = (wall_s - result["startup_s"]) / n_subjects
+    # a single participant, as a cluster job would run it
+    single = common + ["--participant_label", first_subject[len("sub-"):]]
+    result["single_subject_plan_s"], result["single_subject_plan_max_rss_mb"] = \
+        timed_run(single + ["--plan_only"], env)
+    # and running its stub stages through checkpointing, logging and profiling
+    result["single_subject_run_s"], result["single_subject_run_max_rss_mb"] = \
+        timed_run(single + ["--stage_logs", "file"], env)
+    return result
+
+def compare(results, baseline_file, tolerance):
+    with open(baseline_file) as fp:
+        baseline = {r["n_subjects"]: r for r in json.load(fp)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["n_subjects"])
+        if previous is None:
+            continue
+        for metric in regression_metrics:
+            if metric in previous and result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append("%d subjects: %s %.3fs, was %.3fs"%(result["n_subjects"], metric,
+                                                                      result[metric], previous[metric]))
+    return regressions
+
+parser = argparse.ArgumentParser(description='Benchmark of the overhead of the HCP Pipelines BIDS App '
+                                 'wrapper on synthetic datasets, with stub HCP Pipelines scripts')
+parser.add_argument('work_dir', help='Directory for the synthetic datasets and outputs. Datasets '
+                    'that already exist there are reused.')
+parser.add_argument('--subjects', help='Dataset sizes (number of participants) to benchmark.',
+                    nargs="+", type=int, default=[10, 100, 1000])
+parser.add_argument('--sessions', help='Number of sessions per participant (0 for none).',
+                    type=int, default=2)
+parser.add_argument('--bolds', help='Number of BOLD runs per session.', type=int, default=2)
+parser.add_argument('--output', help='Write the results as JSON to this file.')
+parser.add_argument('--baseline', help='Results of an earlier benchmark to compare against; '
+                    'exits with an error when a timing got slower than the tolerance.')
+parser.add_argument('--tolerance', help='Allowed slowdown relative to the baseline, as a fraction.',
+                    type=float, default=0.25)
+bench_args = parser.parse_args()
+
+work_dir = os.path.abspath(bench_args.work_dir)
+env = make_stub_environment(os.path.join(work_dir, "stubs"))
+results = []
+for n_subjects in bench_args.subjects:
+    result = benchmark_size(work_dir, n_subjects, env, bench_args)
+    print(json.dumps(result))
+    results.append(result)
+
+if bench_args.output:
+    with open(bench_args.output, "w") as fp:
+        json.dump({"results": results}, fp, indent=2)
+
+if bench_args.baseline:
+    regressions = compare(results, bench_args.baseline, bench_args.tolerance)
+    for regression in regressions:
+        print("Regression: " + regression)
+    if regressions:
+        sys.exit(1)
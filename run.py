@@ -1,7 +1,18 @@
 #!/usr/local/miniconda/bin/python
 import argparse
+import datetime
+import fcntl
+import filecmp
+import gzip
+import hashlib
+import json
 import os
+import re
 import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
 import nibabel
 from glob import glob
 from subprocess import Popen, PIPE
@@ -9,36 +20,748 @@ from shutil import rmtree
 import subprocess
 from bids.layout import BIDSLayout
 from bids.layout.models import *
+from contextlib import closing, contextmanager, nullcontext
 from functools import partial
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
 import numpy as np
 
-def run(command, env={}, cwd=None):
-    merged_env = os.environ
+# number of trailing output lines of a stage shown when it fails
+log_tail_lines = 100
+
+# the parsed command line options and what follows from them, see configure()
+args = None
+session_to_analyze = dict()
+# a single index of the whole dataset, see main()
+dataset_layout = None
+
+def wait_with_rusage(process, usage, watch=None):
+    # unlike getrusage(RUSAGE_CHILDREN), wait4 reports the resources of this
+    # child (and its reaped descendants) only, also when stages run concurrently.
+    # Its max_rss_kb is the peak of the largest single process though, the
+    # whole stage can use more with processes running side by side:
+    # tree_max_rss_kb is the peak of their sum, sampled by the watchdog
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if usage is not None:
+        usage.update({"user_s": rusage.ru_utime,
+                      "sys_s": rusage.ru_stime,
+                      "max_rss_kb": rusage.ru_maxrss,
+                      "tree_max_rss_kb": max(rusage.ru_maxrss, watch["tree_rss_kb"] if watch else 0),
+                      "returncode": process.returncode})
+
+# the processes started by run(), checked by a single watchdog thread for wall
+# time limits and silent (hanging) stages. Every process is the leader of a
+# process group of its own, which is killed as a whole
+running_processes = {}
+running_processes_lock = threading.Lock()
+watchdog = None
+watchdog_interval_s = 5
+# seconds a stage gets to exit after SIGTERM before it is killed with SIGKILL
+kill_grace_s = 10
+# set on SIGTERM, no further stages are started after that
+terminating = threading.Event()
+
+def signal_process_group(watch, reason):
+    # SIGTERM first, SIGKILL when the group is still there on the next call.
+    # Takes no lock and does not print, so that it is safe in a signal handler
+    if watch["killed"] is None:
+        watch["killed"] = time.time()
+        watch["reason"] = reason
+        sig = signal.SIGTERM
+    else:
+        sig = signal.SIGKILL
+    try:
+        os.killpg(watch["process"].pid, sig)
+    except ProcessLookupError:
+        pass
+
+def kill_process_group(watch, reason):
+    if watch["killed"] is None:
+        print(f"BIDS App wrapper: killing {watch['name']}: {reason}")
+    signal_process_group(watch, reason)
+
+def process_group_rss_kb():
+    # resident memory by process group, summed over its processes (shared
+    # pages are counted in every process that maps them)
+    page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+    rss = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as fp:
+                # the fields after the command name, which may contain spaces
+                fields = fp.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        pgrp, pages = int(fields[2]), int(fields[21])
+        rss[pgrp] = rss.get(pgrp, 0) + pages * page_kb
+    return rss
+
+def watch_processes():
+    while True:
+        time.sleep(watchdog_interval_s)
+        now = time.time()
+        with running_processes_lock:
+            watches = list(running_processes.values())
+        rss = process_group_rss_kb() if watches else {}
+        for watch in watches:
+            watch["tree_rss_kb"] = max(watch["tree_rss_kb"], rss.get(watch["process"].pid, 0))
+            if watch["killed"] is not None:
+                if now - watch["killed"] > kill_grace_s:
+                    kill_process_group(watch, watch["reason"])
+            elif watch["timeout"] and now - watch["start"] > watch["timeout"]:
+                kill_process_group(watch, "exceeded its wall time limit of %.0fs"%watch["timeout"])
+            elif watch["silence_timeout"] and now - watch["last_output"] > watch["silence_timeout"]:
+                kill_process_group(watch, "no output for %.0fs, assuming it hangs"%watch["silence_timeout"])
+
+def watch_process(process, name, timeout, silence_timeout):
+    global watchdog
+    watch = {"process": process, "name": name, "start": time.time(), "last_output": time.time(),
+             "timeout": timeout, "silence_timeout": silence_timeout, "killed": None, "reason": None,
+             "tree_rss_kb": 0}
+    with running_processes_lock:
+        running_processes[process.pid] = watch
+        # a forked participant worker inherits the global but not the thread
+        if watchdog is None or not watchdog.is_alive():
+            watchdog = threading.Thread(target=watch_processes, name="watchdog", daemon=True)
+            watchdog.start()
+    return watch
+
+def unwatch_process(watch):
+    with running_processes_lock:
+        running_processes.pop(watch["process"].pid, None)
+    if watch["killed"] is not None:
+        raise Exception("%s was killed: %s"%(watch["name"], watch["reason"]))
+
+def terminate(signum, frame):
+    # e.g. a batch system ending the job or Ctrl-C: the stages are killed right away so
+    # that they do not keep running without the wrapper, and participant
+    # worker processes are told to do the same
+    terminating.set()
+    for child in multiprocessing.active_children():
+        try:
+            os.kill(child.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    # no lock here: the handler may interrupt the main thread while it holds it
+    for watch in list(running_processes.values()):
+        signal_process_group(watch, "received %s"%signal.Signals(signum).name)
+    # the threads running the stages reap them as they exit
+    deadline = time.time() + kill_grace_s
+    while running_processes and time.time() < deadline:
+        time.sleep(0.1)
+    for watch in list(running_processes.values()):
+        signal_process_group(watch, watch["reason"])
+    raise SystemExit(128 + signum)
+
+def reset_watchdog_after_fork():
+    # the parent's processes are not children of a forked worker, and the
+    # lock may have been held by one of the parent's threads during the fork
+    global running_processes, running_processes_lock, watchdog
+    running_processes = {}
+    running_processes_lock = threading.Lock()
+    watchdog = None
+
+os.register_at_fork(after_in_child=reset_watchdog_after_fork)
+
+@contextmanager
+def pinned_thread(cpus):
+    # the affinity of the calling thread only (not of the other stage threads),
+    # which a process started meanwhile inherits before it runs anything
+    if not cpus:
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+def run(command, env={}, cwd=None, log_file=None, usage=None, cpus=None,
+        name=None, timeout=None, silence_timeout=None):
+    if terminating.is_set():
+        raise Exception("Terminating, not starting %s"%(name or command))
+    # copy so that concurrently running stages do not share or leak their env
+    merged_env = dict(os.environ)
     merged_env.update(env)
     merged_env.pop("DEBUG", None)
     print(command)
-    process = Popen(command, stdout=PIPE, stderr=subprocess.STDOUT,
-                    shell=True, env=merged_env, cwd=cwd,
-                    universal_newlines=True)
-    while True:
-        line = process.stdout.readline()
-        print(line.rstrip())
-        line = str(line)[:-1]
-        if line == '' and process.poll() != None:
-            break
+    start = time.time()
+    if usage is not None:
+        usage["start"] = start
+    if log_file is None:
+        with pinned_thread(cpus):
+            process = Popen(command, stdout=PIPE, stderr=subprocess.STDOUT,
+                            shell=True, env=merged_env, cwd=cwd, start_new_session=True,
+                            universal_newlines=True)
+        watch = watch_process(process, name or command.split()[0], timeout, silence_timeout)
+        while True:
+            line = process.stdout.readline()
+            if line == '':
+                break
+            watch["last_output"] = time.time()
+            print(line.rstrip())
+        wait_with_rusage(process, usage, watch)
+        if usage is not None:
+            usage["wall_s"] = time.time() - start
+        unwatch_process(watch)
+        if process.returncode != 0:
+            raise Exception("Non zero return code: %d"%process.returncode)
+        return
+
+    # copy the raw output to the log in large chunks, only the last lines are
+    # kept in memory for reporting a failure
+    print(f"BIDS App wrapper: writing output to {log_file}")
+    Path(os.path.dirname(log_file)).mkdir(parents=True, exist_ok=True)
+    tail = deque(maxlen=log_tail_lines)
+    partial_line = b""
+    opener = gzip.open if log_file.endswith(".gz") else open
+    with opener(log_file, "wb") as log:
+        with pinned_thread(cpus):
+            process = Popen(command, stdout=PIPE, stderr=subprocess.STDOUT,
+                            shell=True, env=merged_env, cwd=cwd, start_new_session=True)
+        watch = watch_process(process, name or command.split()[0], timeout, silence_timeout)
+        while True:
+            chunk = process.stdout.read1(1 << 16)
+            if not chunk:
+                break
+            watch["last_output"] = time.time()
+            log.write(chunk)
+            lines = (partial_line + chunk).split(b"\n")
+            partial_line = lines.pop()
+            tail.extend(lines)
+        if partial_line:
+            tail.append(partial_line)
+        wait_with_rusage(process, usage, watch)
+    if usage is not None:
+        usage["wall_s"] = time.time() - start
+    if process.returncode != 0 or watch["killed"] is not None:
+        print(f"BIDS App wrapper: last {len(tail)} lines of {log_file}:")
+        for line in tail:
+            print(line.decode(errors="replace").rstrip())
+    unwatch_process(watch)
     if process.returncode != 0:
-        raise Exception("Non zero return code: %d"%process.returncode)
+        raise Exception("Non zero return code: %d (see %s)"%(process.returncode, log_file))
+
+def hcp_pipelines_version():
+    version_file = os.path.join(os.environ.get("HCPPIPEDIR", ""), "version.txt")
+    if os.path.exists(version_file):
+        with open(version_file) as fp:
+            return fp.read().strip()
+    return "unknown"
+
+def stage_inputs(cmd, path):
+    # identities of the files a stage reads from outside the output directory;
+    # outputs of upstream stages are covered by their own completion records
+    output_dirs = tuple(os.path.realpath(d) + os.sep for d in [path, args.output_dir])
+    files = set()
+    for token in re.findall(r"/[^\s\"'@=]+", cmd):
+        if os.path.isfile(token) and not os.path.realpath(token).startswith(output_dirs):
+            files.add(token)
+            stem = re.sub(r"\.nii(\.gz)?$", "", token)
+            files.update(stem + ext for ext in [".json", ".bval", ".bvec"]
+                         if stem != token and os.path.isfile(stem + ext))
+    inputs = []
+    for f in sorted(files):
+        stat = os.stat(f)
+        inputs.append([f, stat.st_size, stat.st_mtime_ns])
+    return inputs
+
+def checkpoint_file(path, subject, stage_id):
+    return os.path.join(path, "checkpoints", subject, stage_id + ".json")
+
+def write_checkpoint(record_file, record):
+    Path(os.path.dirname(record_file)).mkdir(parents=True, exist_ok=True)
+    with open(record_file + ".tmp", "w") as fp:
+        json.dump(record, fp, indent=2)
+    os.replace(record_file + ".tmp", record_file)
+
+def read_checkpoint(record_file):
+    try:
+        with open(record_file) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+# size, mtime and checksum of every file of a subject with the stage that
+# wrote it (--output_manifest), for incremental syncing and for confirming
+# that the outputs of completed stages are intact
+manifest_lock = threading.Lock()
+
+def manifest_file(path, subject):
+    return os.path.join(path, "manifests", subject + ".json")
+
+def shared_digests_file(path):
+    # checksums of files shared between subjects (the symlinked or hard linked
+    # FreeSurfer templates), by device, inode, size and mtime, so that they
+    # are hashed once and not again for every subject
+    return os.path.join(path, "manifests", "shared_digests.json")
+
+def file_checksum(path, chunk_size=1 << 20):
+    # hashlib releases the GIL on large updates, so files hash in parallel;
+    # None for files removed in the meantime (e.g. by a concurrent stage)
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as fp:
+            for chunk in iter(partial(fp.read, chunk_size), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+def update_output_manifest(path, subject, stage_id, max_workers=8):
+    # files whose size and mtime did not change keep their entry, new and
+    # changed files are hashed and attributed to the stage that just completed
+    # (with concurrent stages, to the first of them that completes)
+    with manifest_lock:
+        target = manifest_file(path, subject)
+        previous = (read_checkpoint(target) or {}).get("files", {})
+        shared = read_checkpoint(shared_digests_file(path)) or {}
+        subject_root = os.path.realpath(os.path.join(path, subject))
+        files = OrderedDict()
+        changed = []
+        shared_keys = {}
+        # symlinked directories, e.g. the FreeSurfer templates, are followed
+        # unless they lead back to a directory that was already walked
+        walked = set()
+        for dirpath, dirnames, filenames in os.walk(os.path.join(path, subject), followlinks=True):
+            walked.add(os.path.realpath(dirpath))
+            dirnames[:] = sorted(name for name in dirnames
+                                 if os.path.realpath(os.path.join(dirpath, name)) not in walked)
+            for name in sorted(filenames):
+                full = os.path.join(dirpath, name)
+                relative = os.path.relpath(full, path)
+                try:
+                    stat = os.lstat(full)
+                    link = os.readlink(full) if os.path.islink(full) else None
+                except FileNotFoundError:
+                    continue
+                entry = previous.get(relative)
+                if entry and (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                    files[relative] = entry
+                    continue
+                files[relative] = OrderedDict([("size", stat.st_size), ("mtime_ns", stat.st_mtime_ns),
+                                               ("stage", stage_id)])
+                # symlinks are recorded by their target
+                if link is not None:
+                    files[relative]["link"] = link
+                    continue
+                changed.append(relative)
+                if stat.st_nlink > 1 or not os.path.realpath(full).startswith(subject_root + os.sep):
+                    shared_keys[relative] = "%d:%d:%d:%d"%(stat.st_dev, stat.st_ino, stat.st_size,
+                                                           stat.st_mtime_ns)
+                    if shared_keys[relative] in shared:
+                        files[relative]["blake2b"] = shared[shared_keys[relative]]
+        to_hash = [relative for relative in changed if "blake2b" not in files[relative]]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(to_hash) or 1)) as executor:
+            checksums = executor.map(file_checksum, [os.path.join(path, relative) for relative in to_hash])
+            for relative, checksum in zip(to_hash, checksums):
+                if checksum is None:
+                    del files[relative]
+                    changed.remove(relative)
+                else:
+                    files[relative]["blake2b"] = checksum
+        new_shared = {shared_keys[relative]: files[relative]["blake2b"]
+                      for relative in to_hash if relative in shared_keys and relative in files}
+        if new_shared:
+            # merged with those of concurrent subjects in other processes
+            Path(os.path.dirname(shared_digests_file(path))).mkdir(parents=True, exist_ok=True)
+            with open(shared_digests_file(path) + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                shared = read_checkpoint(shared_digests_file(path)) or {}
+                shared.update(new_shared)
+                write_checkpoint(shared_digests_file(path), shared)
+        write_checkpoint(target, {"subject": subject, "updated": datetime.datetime.now().isoformat(),
+                                  "files": files})
+    return changed
+
+def forget_manifest_paths(path, subject, relative):
+    # files removed on purpose, e.g. pruned intermediates
+    with manifest_lock:
+        target = manifest_file(path, subject)
+        manifest = read_checkpoint(target)
+        if manifest is None:
+            return
+        manifest["files"] = OrderedDict((f, entry) for f, entry in manifest["files"].items()
+                                        if f != relative and not f.startswith(relative + os.sep))
+        write_checkpoint(target, manifest)
+
+def changed_stage_outputs(path, subject, stage_id):
+    # files recorded for a stage that are gone or no longer match by size and mtime
+    manifest = read_checkpoint(manifest_file(path, subject)) or {"files": {}}
+    changed = []
+    for relative, entry in manifest["files"].items():
+        if entry["stage"] != stage_id:
+            continue
+        try:
+            stat = os.lstat(os.path.join(path, relative))
+        except OSError:
+            changed.append(relative)
+            continue
+        if (entry["size"], entry["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            changed.append(relative)
+    return changed
+
+def stage_log_file(stage_args):
+    if args.stage_logs == "console":
+        return None
+    stage_id = stage_args.get("stage_id", stage_args["subject"])
+    return os.path.join(stage_args["path"], "logs", stage_args["subject"],
+                        stage_id + (".log.gz" if args.stage_logs == "gzip" else ".log"))
+
+usage_lock = threading.Lock()
+
+def write_usage_trace(records, trace_file):
+    # Chrome trace / Perfetto timeline, concurrent stages are put on separate lanes
+    events = [{"name": "process_name", "ph": "M", "pid": 1,
+               "args": {"name": records[0]["subject"] if records else ""}}]
+    lane_ends = []
+    for record in sorted(records, key=lambda r: r["start"]):
+        lane = next((i for i, end in enumerate(lane_ends) if end <= record["start"]), len(lane_ends))
+        if lane == len(lane_ends):
+            lane_ends.append(0)
+        lane_ends[lane] = record["start"] + record["wall_s"]
+        events.append({"name": record["stage"], "cat": record["subject"], "ph": "X",
+                       "ts": int(record["start"] * 1e6), "dur": int(record["wall_s"] * 1e6),
+                       "pid": 1, "tid": lane, "args": record})
+    with open(trace_file + ".tmp", "w") as fp:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+    os.replace(trace_file + ".tmp", trace_file)
+
+def record_stage_usage(stage_args, usage):
+    subject = stage_args["subject"]
+    record = OrderedDict([("subject", subject),
+                          ("stage", stage_args.get("stage_id", subject)),
+                          ("run", stage_args.get("fmriname")),
+                          ("n_cpus", stage_args["n_cpus"]),
+                          ("input_voxels", stage_args.get("input_voxels")),
+                          ("hcp_pipelines_version", hcp_pipelines_version())])
+    record.update(usage)
+    profile_dir = os.path.join(stage_args["path"], "profiling")
+    usage_file = os.path.join(profile_dir, subject + "_resource_usage.jsonl")
+    with usage_lock:
+        Path(profile_dir).mkdir(parents=True, exist_ok=True)
+        with open(usage_file, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+        with open(usage_file) as fp:
+            records = [json.loads(line) for line in fp if line.strip()]
+        write_usage_trace(records, os.path.join(profile_dir, subject + "_trace.json"))
+
+def pooled_stage(stage_id, run=None):
+    # the stage of a node, the runs of fMRIVolume/fMRISurface are pooled
+    if run and stage_id.endswith("_" + run):
+        return stage_id[:-len(run) - 1]
+    return stage_id
+
+# one connection to the stage history per process, shared by its stage threads
+# under the lock. A forked worker opens its own, as an SQLite connection must
+# not be used across fork, and leaves the inherited one alone
+history_connections = {}
+history_lock = threading.Lock()
+history_timeout_s = 2
+
+def reset_history_lock_after_fork():
+    global history_lock
+    history_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=reset_history_lock_after_fork)
+
+def history_connection():
+    # stage runs of this and earlier runs, for runtime estimates and progress;
+    # to be called with history_lock held
+    if os.getpid() in history_connections:
+        return history_connections[os.getpid()]
+    # node-local by default: the output directory is often on shared storage,
+    # where SQLite locking is slow or broken
+    history_db = args.history_db or os.path.join(tempfile.gettempdir(),
+                                                 "hcppipelines_stage_history_%d.sqlite"%os.getuid())
+    # a busy database is skipped rather than holding up the stage
+    connection = sqlite3.connect(history_db, timeout=history_timeout_s, isolation_level=None,
+                                 check_same_thread=False)
+    connection.execute("CREATE TABLE IF NOT EXISTS stage_runs ("
+                       "id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT, stage TEXT, node TEXT, "
+                       "n_cpus INTEGER, input_voxels INTEGER, hcp_pipelines_version TEXT, host TEXT, "
+                       "started REAL, finished REAL, wall_s REAL, status TEXT)")
+    connection.execute("CREATE INDEX IF NOT EXISTS stage_runs_stage ON stage_runs (stage, status)")
+    history_connections[os.getpid()] = connection
+    return connection
+
+def record_stage_start(stage_args):
+    try:
+        with history_lock:
+            return history_connection().execute(
+                "INSERT INTO stage_runs (subject, stage, node, n_cpus, input_voxels, "
+                "hcp_pipelines_version, host, started, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'running')",
+                (stage_args["subject"], pooled_stage(stage_args["stage_id"], stage_args.get("fmriname")),
+                 stage_args["stage_id"], stage_args["n_cpus"], stage_args.get("input_voxels"),
+                 hcp_pipelines_version(), socket.gethostname(), time.time())).lastrowid
+    except (sqlite3.Error, OSError) as e:
+        # the history is informative only, a stage does not fail because of it
+        print(f"BIDS App wrapper: could not record {stage_args['stage_id']} in the stage history: {e}")
+
+def record_stage_end(run_id, usage):
+    if run_id is None:
+        return
+    try:
+        with history_lock:
+            history_connection().execute(
+                "UPDATE stage_runs SET finished = ?, wall_s = ?, status = ? WHERE id = ?",
+                (time.time(), usage.get("wall_s"), "done" if usage.get("returncode") == 0 else "failed", run_id))
+    except (sqlite3.Error, OSError) as e:
+        print(f"BIDS App wrapper: could not record the end of a stage in the stage history: {e}")
+
+def runtime_history():
+    # completed runs by stage, as records like those of measured_stage_usage()
+    history = {}
+    try:
+        with history_lock:
+            rows = history_connection().execute("SELECT stage, n_cpus, input_voxels, wall_s FROM stage_runs "
+                                                "WHERE status = 'done' ORDER BY id").fetchall()
+    except (sqlite3.Error, OSError):
+        return history
+    for stage, n_cpus, input_voxels, wall_s in rows:
+        history.setdefault(stage, []).append({"n_cpus": n_cpus, "input_voxels": input_voxels,
+                                              "wall_s": wall_s})
+    return history
+
+def estimate_runtime_s(stage, n_cpus, input_voxels, records):
+    # median of earlier runs of the stage scaled to the size of the input,
+    # preferring the runs with the same number of cores
+    records = [r for r in records or [] if r.get("wall_s")]
+    records = [r for r in records if r.get("n_cpus") == n_cpus] or records
+    if not records:
+        return stage_runtime_defaults.get(stage, 3600)
+    return float(np.median([r["wall_s"] * input_voxels / r["input_voxels"]
+                            if input_voxels and r.get("input_voxels") else r["wall_s"]
+                            for r in records]))
+
+# the thread pools of the tools called by the HCP Pipelines (OpenMP, including
+# wb_command, ITK, MKL and OpenBLAS) all default to one thread per core
+thread_count_variables = ["OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+                          "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                          "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+
+def parse_cpu_list(text):
+    cpus = set()
+    for part in text.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def numa_nodes(cpus):
+    nodes = []
+    for cpulist in sorted(glob("/sys/devices/system/node/node[0-9]*/cpulist"),
+                          key=lambda f: int(re.search(r"node(\d+)/", f).group(1))):
+        with open(cpulist) as fp:
+            node = parse_cpu_list(fp.read()) & cpus
+        if node:
+            nodes.append(node)
+    rest = cpus.difference(*nodes)
+    if rest:
+        nodes.append(rest)
+    return nodes
+
+def numa_ordered(cpus):
+    return [cpu for node in numa_nodes(set(cpus)) for cpu in sorted(node)]
+
+class CpuAllocator(object):
+    # hands out disjoint sets of cores to concurrently running stages, from a
+    # single NUMA node whenever one has enough free cores
+    def __init__(self, cpus):
+        self.nodes = numa_nodes(set(cpus))
+        self.free = set(cpus)
+        self.condition = threading.Condition()
+
+    def acquire(self, n_cpus):
+        n_cpus = max(1, min(n_cpus, sum(len(node) for node in self.nodes)))
+        with self.condition:
+            while len(self.free) < n_cpus:
+                self.condition.wait()
+            free_nodes = [node & self.free for node in self.nodes]
+            fitting = [node for node in free_nodes if len(node) >= n_cpus]
+            if fitting:
+                # the tightest fit leaves larger free nodes to larger stages
+                cpus = sorted(min(fitting, key=len))[:n_cpus]
+            else:
+                cpus = []
+                for node in sorted(free_nodes, key=len, reverse=True):
+                    cpus += sorted(node)[:n_cpus - len(cpus)]
+            self.free.difference_update(cpus)
+            return set(cpus)
+
+    def release(self, cpus):
+        with self.condition:
+            self.free.update(cpus)
+            self.condition.notify_all()
+
+# set up by configure() (and in every participant worker) with --pin_cpus
+cpu_allocator = None
+
+# per stage settings from --stage_timeout (hours) and --stage_retries, by
+# stage with "" for all other stages
+stage_timeouts = {}
+stage_retries = {}
+
+def parse_stage_settings(option, values, value_type):
+    settings = {}
+    for value in values or []:
+        stage, _, setting = value.rpartition("=")
+        try:
+            settings[stage] = value_type(setting)
+        except ValueError:
+            raise Exception("Invalid %s %s, expected <value> or <stage>=<value>"%(option, value))
+    return settings
+
+def stage_setting(settings, stage_id, default=None):
+    # the most specific setting, e.g. DiffusionPreprocessing_Eddy before
+    # DiffusionPreprocessing, and fMRIVolume for fMRIVolume_<run>
+    matches = [stage for stage in settings
+               if stage == "" or stage_id == stage or stage_id.startswith(stage + "_")]
+    return settings[max(matches, key=len)] if matches else default
+
+def stage_time_limit(stage_id):
+    hours = stage_setting(stage_timeouts, stage_id)
+    return hours * 3600 if hours else None
+
+def thread_count_env(env, n_threads):
+    # the stage's env with every thread count set to its cores, also used for
+    # exported jobs so that they run with the same threading
+    env = dict(env)
+    env.update((variable, str(n_threads)) for variable in thread_count_variables)
+    if "NSLOTS" in env:
+        env["NSLOTS"] = str(n_threads)
+    return env
+
+def run_stage(cmd, stage_args, env={}):
+    usage = {}
+    cpus = cpu_allocator.acquire(stage_args["n_cpus"]) if cpu_allocator else None
+    env = thread_count_env(env, len(cpus) if cpus else stage_args["n_cpus"])
+    if cpus:
+        usage["cpus"] = sorted(cpus)
+    run_id = record_stage_start(stage_args) if "stage_id" in stage_args else None
+    try:
+        stage_id = stage_args.get("stage_id", stage_args["subject"])
+        run(cmd, cwd=stage_args["path"], env=env, log_file=stage_log_file(stage_args),
+            usage=usage, cpus=cpus, name=f"{stage_args['subject']} {stage_id}",
+            timeout=stage_time_limit(stage_id),
+            silence_timeout=args.stage_silence_timeout and args.stage_silence_timeout * 60)
+    finally:
+        if cpus:
+            cpu_allocator.release(cpus)
+        if "wall_s" in usage:
+            record_stage_usage(stage_args, usage)
+        record_stage_end(run_id, usage)
+
+def run_checkpointed(cmd, stage_args, env={}, runner=None):
+    # only report what would be run, e.g. for exporting a job manifest
+    if stage_args.get("dry_run"):
+        return {"command": cmd, "env": thread_count_env(env, stage_args["n_cpus"])}
+    # stages called outside of the stage graph have no identity to checkpoint
+    if "stage_id" not in stage_args:
+        if runner:
+            runner()
+        else:
+            run_stage(cmd, stage_args, env=env)
+        return
+
+    path, subject = stage_args["path"], stage_args["subject"]
+    # a stage run in a --work_dir is the same as one run in the output directory
+    record = {"stage": stage_args["stage_id"],
+              "command_sha256": hashlib.sha256(cmd.replace(path, args.output_dir).encode()).hexdigest(),
+              "inputs": stage_inputs(cmd, path),
+              "hcp_pipelines_version": hcp_pipelines_version(),
+              "depends": {}}
+    # rerunning any upstream stage invalidates this stage too
+    pruned_depends = []
+    for dep in stage_args.get("stage_depends", []):
+        dep_record = read_checkpoint(checkpoint_file(path, subject, dep))
+        record["depends"][dep] = dep_record["completed"] if dep_record else None
+        if dep_record and dep_record.get("pruned"):
+            pruned_depends.append(dep)
+    record["fingerprint"] = hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+    record_file = checkpoint_file(path, subject, stage_args["stage_id"])
+    previous = read_checkpoint(record_file)
+    if previous and previous.get("fingerprint") == record["fingerprint"] and not stage_args.get("force_stage"):
+        changed = changed_stage_outputs(path, subject, stage_args["stage_id"]) if args.output_manifest else []
+        if not changed:
+            print(f"BIDS App wrapper: {stage_args['stage_id']} already completed on {previous['completed']} "
+                  "with the same command and inputs, skipping (see --force_stages)")
+            return
+        print(f"BIDS App wrapper: {len(changed)} output(s) of {stage_args['stage_id']} are missing or were "
+              f"modified since it completed on {previous['completed']}, e.g. {changed[0]}, running it again")
+
+    if pruned_depends:
+        print(f"BIDS App wrapper: intermediates of {', '.join(pruned_depends)} were removed (see --keep), "
+              f"{stage_args['stage_id']} may need them to be rerun as well (see --force_stages)")
+    if os.path.exists(record_file):
+        os.remove(record_file)
+    # a runner carries out the command in its own way, e.g. in checkpointed parts
+    if runner:
+        runner()
+    else:
+        run_stage(cmd, stage_args, env=env)
+
+    record["completed"] = datetime.datetime.now().isoformat()
+    # the arguments of the retry that completed, used right away by reruns
+    if stage_args.get("retry_args"):
+        record["retry_args"] = stage_args["retry_args"]
+    if args.output_manifest:
+        record["changed_outputs"] = len(update_output_manifest(path, subject, stage_args["stage_id"]))
+    write_checkpoint(record_file, record)
+
+# arguments a stage is run with on successive retries after a failure: eddy
+# falls back from the GPU to the CPU version
+stage_retry_args = {"DiffusionPreprocessing": [{"eddy_no_gpu": True}],
+                    "DiffusionPreprocessing_Eddy": [{"eddy_no_gpu": True}]}
+
+def run_with_retries(func, stage, **stage_args):
+    # func is the partial of a stage node; failed attempts are retried up to
+    # --stage_retries times with exponential backoff
+    retries = stage_setting(stage_retries, stage_args["stage_id"], 0)
+    variants = [{}] + [variant for variant in stage_retry_args.get(stage, [])
+                       if any(func.keywords.get(key) != value for key, value in variant.items())]
+    # a stage that completed with retry arguments before starts with them
+    previous = read_checkpoint(checkpoint_file(func.keywords["path"], func.keywords["subject"],
+                                               stage_args["stage_id"]))
+    if previous and previous.get("retry_args") in variants:
+        variants = variants[variants.index(previous["retry_args"]):]
+    for attempt in range(retries + 1):
+        variant = variants[min(attempt, len(variants) - 1)]
+        # --force_stages applies to the first attempt, a retry resumes after
+        # the parts (e.g. of diffusion) that completed in the meantime
+        if attempt:
+            stage_args["force_stage"] = False
+        try:
+            return func(**stage_args, **variant, retry_args=variant)
+        except Exception as e:
+            if attempt == retries or terminating.is_set():
+                raise
+            delay = args.stage_retry_backoff * 2 ** attempt
+            next_variant = variants[min(attempt + 1, len(variants) - 1)]
+            print(f"BIDS App wrapper: {stage_args['stage_id']} failed ({e}), retry {attempt + 1} of "
+                  f"{retries} in {delay:g}s" + (f" with {next_variant}" if next_variant else ""))
+            if terminating.wait(delay):
+                raise
 
 grayordinatesres = "2" # This is currently the only option for which the is an atlas
 lowresmesh = 32
 
 def run_pre_freesurfer(**args):
     args.update(os.environ)
-    args["t1"] = "@".join(t1ws)
-    if t2ws != "NONE":
-        args["t2"] = "@".join(t2ws)
+    args["t1"] = "@".join(args["t1ws"])
+    if args["t2ws"] != "NONE":
+        args["t2"] = "@".join(args["t2ws"])
     else:
         args["t2"] = "NONE"
         args["t2_template_res"] = args["t1_template_res"]
@@ -75,7 +798,239 @@ def run_pre_freesurfer(**args):
     '--processing-mode="{processing_mode}" ' + \
     '--printcom=""'
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def reflink_or_copy(src, dst):
+    # FICLONE shares the file's extents on btrfs/XFS; other filesystems copy
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def publish_tree(src, dst, copy_function=shutil.copy2):
+    # build next to the destination and rename it into place, so concurrent
+    # jobs never see a partial tree; the first one to finish wins
+    tmp = "%s.tmp%d_%d"%(dst, os.getpid(), threading.get_ident())
+    shutil.copytree(src, tmp, symlinks=True, copy_function=copy_function)
+    try:
+        os.rename(tmp, dst)
+    except OSError:
+        shutil.rmtree(tmp)
+        if not os.path.isdir(dst):
+            raise
+
+def shared_fs_template(template, output_dir):
+    # a single read-only copy of the template per output directory
+    shared = os.path.join(output_dir, "fs_templates", template)
+    if not os.path.isdir(shared):
+        Path(os.path.dirname(shared)).mkdir(parents=True, exist_ok=True)
+        def read_only_copy(src, dst):
+            shutil.copy2(src, dst)
+            os.chmod(dst, os.stat(dst).st_mode & ~0o222)
+        publish_tree(os.path.join(os.environ["SUBJECTS_DIR"], template), shared, read_only_copy)
+    return shared
+
+def materialize_fs_template(template, output_dir, subject_dir, mode):
+    target = os.path.join(subject_dir, template)
+    if os.path.lexists(target):
+        return
+    if mode == "copy":
+        shutil.copytree(os.path.join(os.environ["SUBJECTS_DIR"], template), target)
+        return
+
+    shared = shared_fs_template(template, output_dir)
+    Path(subject_dir).mkdir(parents=True, exist_ok=True)
+    if mode == "symlink":
+        try:
+            os.symlink(os.path.relpath(shared, subject_dir), target)
+        except FileExistsError:
+            pass
+    else:
+        publish_tree(shared, target, link_or_copy if mode == "hardlink" else reflink_or_copy)
+
+class Throttle(object):
+    # limits the average rate of a copy to mb_per_s (0 for no limit)
+    def __init__(self, mb_per_s):
+        self.rate = mb_per_s * 1024.0 ** 2
+        self.start = time.time()
+        self.copied = 0
+
+    def __call__(self, n_bytes):
+        if not self.rate:
+            return
+        self.copied += n_bytes
+        ahead = self.copied / self.rate - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+def copy_throttled(src, dst, throttle):
+    tmp = "%s.tmp%d_%d"%(dst, os.getpid(), threading.get_ident())
+    with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+        while True:
+            chunk = fsrc.read(1 << 20)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            throttle(len(chunk))
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+
+def sync_tree(src, dst, throttle, delete=False):
+    # copy new and changed (by size and mtime) files, symlinks as they are;
+    # with delete, remove what is gone from src (e.g. pruned intermediates)
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        Path(target_root).mkdir(parents=True, exist_ok=True)
+        if delete:
+            for name in set(os.listdir(target_root)) - set(dirs + files):
+                stale = os.path.join(target_root, name)
+                if os.path.isdir(stale) and not os.path.islink(stale):
+                    rmtree(stale)
+                else:
+                    os.remove(stale)
+        for name in dirs + files:
+            source, target = os.path.join(root, name), os.path.join(target_root, name)
+            if os.path.islink(source):
+                if not os.path.islink(target) or os.readlink(target) != os.readlink(source):
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(os.readlink(source), target)
+            elif name in files:
+                source_stat = os.stat(source)
+                try:
+                    target_stat = os.stat(target)
+                    if (target_stat.st_size, target_stat.st_mtime_ns) == \
+                       (source_stat.st_size, source_stat.st_mtime_ns):
+                        continue
+                except FileNotFoundError:
+                    pass
+                copy_throttled(source, target, throttle)
+
+def tree_differences(src, dst, extra=False):
+    # files of dst that are missing, different or (with extra) not in src
+    differences = []
+    if extra:
+        for root, dirs, files in os.walk(dst):
+            for name in dirs + files:
+                target = os.path.join(root, name)
+                if not os.path.lexists(os.path.join(src, os.path.relpath(target, dst))):
+                    differences.append(target)
+            # a directory missing from src is reported as a whole
+            dirs[:] = [name for name in dirs if os.path.lexists(
+                os.path.join(src, os.path.relpath(os.path.join(root, name), dst)))]
+    for root, dirs, files in os.walk(src):
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            target = os.path.join(dst, os.path.relpath(source, src))
+            if os.path.islink(source):
+                if not os.path.islink(target) or os.readlink(target) != os.readlink(source):
+                    differences.append(target)
+            elif name in files and not (os.path.isfile(target) and
+                                        filecmp.cmp(source, target, shallow=False)):
+                differences.append(target)
+    return differences
+
+class StagedOutputs(object):
+    # the stages of a participant write to node-local scratch; a background
+    # thread copies the outputs back to the output directory whenever a stage
+    # completed, and its completion record only after its outputs
+    def __init__(self, subject, work_dir, output_dir, mb_per_s, interval=10):
+        self.subject = subject
+        self.work_path = os.path.join(os.path.abspath(work_dir), subject)
+        self.output_dir = output_dir
+        self.mb_per_s = mb_per_s
+        self.interval = interval
+        self.stop = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.write_back_loop, daemon=True)
+
+    # shared between participants, so not mirrored: files that are not in
+    # this participant's work directory are still used by others
+    shared_trees = ["fs_templates"]
+
+    def trees(self):
+        profiling = [os.path.join("profiling", self.subject + suffix)
+                     for suffix in ["_resource_usage.jsonl", "_trace.json"]]
+        return [self.subject, "fs_templates", os.path.join("logs", self.subject),
+                os.path.relpath(manifest_file(self.work_path, self.subject), self.work_path)] + profiling
+
+    def copy(self, relative, src_dir, dst_dir, throttle, mirror=False):
+        src, dst = os.path.join(src_dir, relative), os.path.join(dst_dir, relative)
+        if os.path.isdir(src):
+            sync_tree(src, dst, throttle, delete=mirror)
+        elif os.path.isfile(src):
+            Path(os.path.dirname(dst)).mkdir(parents=True, exist_ok=True)
+            copy_throttled(src, dst, throttle)
+
+    def checkpoints(self, path):
+        checkpoint_dir = os.path.join(path, "checkpoints", self.subject)
+        return {name: os.stat(os.path.join(checkpoint_dir, name)).st_mtime_ns
+                for name in (os.listdir(checkpoint_dir) if os.path.isdir(checkpoint_dir) else [])
+                if name.endswith(".json")}
+
+    def stage_in(self):
+        # earlier outputs and completion records, so that completed stages are not rerun
+        print(f"BIDS App wrapper: staging {self.subject} in {self.work_path}")
+        Path(self.work_path).mkdir(parents=True, exist_ok=True)
+        for relative in self.trees() + [os.path.join("checkpoints", self.subject)]:
+            self.copy(relative, self.output_dir, self.work_path, Throttle(0))
+        self.thread.start()
+
+    def write_back(self):
+        # only the records of stages that completed before the outputs were
+        # copied, a stage completing meanwhile is copied in the next round
+        completed = self.checkpoints(self.work_path)
+        # a stage that is being rerun is no longer complete in the output directory either
+        for name in set(self.checkpoints(self.output_dir)) - set(completed):
+            os.remove(os.path.join(self.output_dir, "checkpoints", self.subject, name))
+        throttle = Throttle(self.mb_per_s)
+        for relative in self.trees():
+            self.copy(relative, self.work_path, self.output_dir, throttle,
+                      mirror=relative not in self.shared_trees)
+        for name in completed:
+            self.copy(os.path.join("checkpoints", self.subject, name),
+                      self.work_path, self.output_dir, throttle)
+        return completed
+
+    def write_back_loop(self):
+        written = self.checkpoints(self.output_dir)
+        while not self.stop.wait(self.interval):
+            try:
+                if self.checkpoints(self.work_path) != written:
+                    written = self.write_back()
+            except Exception as e:
+                self.error = e
+
+    def finish(self, success):
+        self.stop.set()
+        self.thread.join()
+        self.write_back()
+        differences = []
+        for relative in self.trees() + [os.path.join("checkpoints", self.subject)]:
+            src = os.path.join(self.work_path, relative)
+            if os.path.isdir(src):
+                differences += tree_differences(src, os.path.join(self.output_dir, relative),
+                                                extra=relative not in self.shared_trees)
+            elif os.path.isfile(src) and not filecmp.cmp(src, os.path.join(self.output_dir, relative),
+                                                         shallow=False):
+                differences.append(os.path.join(self.output_dir, relative))
+        if differences:
+            raise Exception("%d file(s) of %s differ from %s after copying them back, e.g. %s"%(
+                            len(differences), self.output_dir, self.work_path, differences[0]))
+        if self.error:
+            print(f"BIDS App wrapper: copying outputs back failed during processing: {self.error}")
+        if success:
+            rmtree(self.work_path)
+        else:
+            print(f"BIDS App wrapper: outputs copied back, keeping {self.work_path} for inspection")
 
 def run_freesurfer(**args):
     args.update(os.environ)
@@ -89,19 +1044,16 @@ def run_freesurfer(**args):
     if args["processing_mode"] != "LegacyStyleData":
         cmd = cmd + '--t2="{path}/{subject}/T1w/T2w_acpc_dc_restore.nii.gz" '
     cmd = cmd.format(**args)
+    env = {"NSLOTS": str(args["n_cpus"]), "OMP_NUM_THREADS": str(args["n_cpus"])}
 
-    if not os.path.exists(os.path.join(args["subjectDIR"], "fsaverage")):
-        shutil.copytree(os.path.join(os.environ["SUBJECTS_DIR"], "fsaverage"),
-                        os.path.join(args["subjectDIR"], "fsaverage"))
-    if not os.path.exists(os.path.join(args["subjectDIR"], "lh.EC_average")):
-        shutil.copytree(os.path.join(os.environ["SUBJECTS_DIR"], "lh.EC_average"),
-                        os.path.join(args["subjectDIR"], "lh.EC_average"))
-    if not os.path.exists(os.path.join(args["subjectDIR"], "rh.EC_average")):
-        shutil.copytree(os.path.join(os.environ["SUBJECTS_DIR"], "rh.EC_average"),
-                        os.path.join(args["subjectDIR"], "rh.EC_average"))
+    # only when FreeSurfer actually runs, not for a completed stage that is skipped
+    def materialize_and_run():
+        for template in ["fsaverage", "lh.EC_average", "rh.EC_average"]:
+            materialize_fs_template(template, args["path"], args["subjectDIR"],
+                                    args.get("fs_templates", "copy"))
+        run_stage(cmd, args, env=env)
 
-    run(cmd, cwd=args["path"], env={"NSLOTS": str(args["n_cpus"]),
-                                    "OMP_NUM_THREADS": str(args["n_cpus"])})
+    return run_checkpointed(cmd, args, env=env, runner=materialize_and_run)
 
 def run_post_freesurfer(**args):
     args.update(os.environ)
@@ -119,7 +1071,7 @@ def run_post_freesurfer(**args):
       '--regname="{regname}" ' + \
       '--processing-mode="{processing_mode}"'
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
 
 def run_generic_fMRI_volume_processsing(**args):
     args.update(os.environ)
@@ -149,7 +1101,7 @@ def run_generic_fMRI_volume_processsing(**args):
       '--slicetimerparams="{slicetimerparams}" '
 
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
 
 def run_generic_fMRI_surface_processsing(**args):
     args.update(os.environ)
@@ -163,7 +1115,7 @@ def run_generic_fMRI_surface_processsing(**args):
       '--grayordinatesres="{grayordinatesres:s}" ' + \
       '--regname="{regname}" '
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
 
 def run_diffusion_processsing(**args):
     args.update(os.environ)
@@ -182,7 +1134,33 @@ def run_diffusion_processsing(**args):
     if args["extra_eddy_args"]:
         cmd = cmd + " ".join(["--extra-eddy-arg="+s for s in args["extra_eddy_args"].split()])
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    if "stage_id" not in args:
+        return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    if args.get("dry_run"):
+        # what is run are the parts, one after the other
+        parts = run_diffusion_parts(args)
+        return {"command": " && ".join(part["command"] for part in parts), "env": parts[0]["env"]}
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])},
+                            runner=partial(run_diffusion_parts, args))
+
+def run_diffusion_parts(args):
+    # DiffPreprocPipeline.sh runs the PreEddy, Eddy and PostEddy scripts in
+    # sequence. Running them one by one checkpoints each of them (with the ids of
+    # the separate stages), so that a rerun or retry resumes after the last
+    # completed part instead of repeating topup and PreEddy
+    common = {key: args[key] for key in ["path", "subject", "n_cpus", "dwiname"]}
+    common.update((key, args[key]) for key in ["input_voxels", "force_stage", "retry_args", "dry_run"]
+                  if key in args)
+    preeddy, eddy, posteddy = [args["stage_id"] + part for part in ["_PreEddy", "_Eddy", "_PostEddy"]]
+    return [run_diffusion_processsing_preeddy(stage_id=preeddy, stage_depends=[], posData=args["posData"],
+                                              negData=args["negData"], echospacing=args["echospacing"],
+                                              PEdir=args["PEdir"], **common),
+            run_diffusion_processsing_eddy(stage_id=eddy, stage_depends=[preeddy],
+                                           eddy_no_gpu=args["eddy_no_gpu"],
+                                           extra_eddy_args=args["extra_eddy_args"], **common),
+            run_diffusion_processsing_posteddy(stage_id=posteddy,
+                                               stage_depends=sorted(args.get("stage_depends", []) + [preeddy, eddy]),
+                                               gdcoeffs=args["gdcoeffs"], **common)]
 
 def run_diffusion_processsing_preeddy(**args):
     args.update(os.environ)
@@ -199,7 +1177,7 @@ def run_diffusion_processsing_preeddy(**args):
       '--b0maxbval={b0maxbval} ' + \
       '--printcom="" '
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
 
 def run_diffusion_processsing_eddy(**args):
     args.update(os.environ)
@@ -213,7 +1191,7 @@ def run_diffusion_processsing_eddy(**args):
     if args["extra_eddy_args"]:
         cmd = cmd + " ".join(["--extra-eddy-arg="+s for s in args["extra_eddy_args"].split()])
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
     
 def run_diffusion_processsing_posteddy(**args):
     args.update(os.environ)
@@ -232,451 +1210,1763 @@ def run_diffusion_processsing_posteddy(**args):
     if 'user_matrix' in args and args['user_matrix']:
         cmd = cmd + ' --user-defined-matrix="{user_matrix}" '
     cmd = cmd.format(**args)
-    run(cmd, cwd=args["path"], env={"OMP_NUM_THREADS": str(args["n_cpus"])})
-
-__version__ = open('/version').read()
-
-parser = argparse.ArgumentParser(description='HCP Pipelines BIDS App (T1w, T2w, fMRI)')
-parser.add_argument('bids_dir', help='The directory with the input dataset '
-                    'formatted according to the BIDS standard.')
-parser.add_argument('output_dir', help='The directory where the output files '
-                    'should be stored. If you are running group level analysis '
-                    'this folder should be prepopulated with the results of the'
-                    'participant level analysis.')
-parser.add_argument('analysis_level', help='Level of the analysis that will be performed. '
-                    'Multiple participant level analyses can be run independently '
-                    '(in parallel) using the same output_dir.',
-                    choices=['participant'])
-parser.add_argument('--participant_label', help='The label of the participant that should be analyzed. The label '
-                   'corresponds to sub-<participant_label> from the BIDS spec '
-                   '(so it does not include "sub-"). If this parameter is not '
-                   'provided all subjects should be analyzed. Multiple '
-                   'participants can be specified with a space separated list.',
-                   nargs="+")
-parser.add_argument('--session_label', help='The label of the session that should be analyzed. The label '
-                   'corresponds to ses-<session_label> from the BIDS spec '
-                   '(so it does not include "ses-"). If this parameter is not '
-                   'provided, all sessions should be analyzed. Multiple '
-                   'sessions can be specified with a space separated list.',
-                   nargs="+")
-parser.add_argument('--n_cpus', help='Number of CPUs/cores available to use.',
-                   default=1, type=int)
-parser.add_argument('--stages', help='Which stages to run. Space separated list.',
-                   nargs="+", choices=['PreFreeSurfer', 'FreeSurfer',
-                                       'PostFreeSurfer', 'fMRIVolume',
-                                       'fMRISurface','DiffusionPreprocessing',
-                                       'DiffusionPreprocessing_PreEddy','DiffusionPreprocessing_Eddy','DiffusionPreprocessing_PostEddy'],
-                   default=['PreFreeSurfer', 'FreeSurfer', 'PostFreeSurfer',
-                            'fMRIVolume', 'fMRISurface'])
-parser.add_argument('--coreg', help='Coregistration method to use',
-                    choices=['MSMSulc', 'FS'], default='MSMSulc')
-parser.add_argument('--gdcoeffs', help='Path to gradients coefficients file',
-                    default="NONE")
-parser.add_argument('--license_key', help='FreeSurfer license key - letters and numbers after "*" in the email you received after registration. To register (for free) visit https://surfer.nmr.mgh.harvard.edu/registration.html',
-                    required=True)
-parser.add_argument('-v', '--version', action='version',
-                    version='HCP Pipelines BIDS App version {}'.format(__version__))
-parser.add_argument('--anat_unwarpdir', help='Unwarp direction for 3D volumes',
-                    choices=['x', 'y', 'z', 'x-', 'y-', 'z-', 'NONE'], default="z")
-parser.add_argument('--skip_bids_validation', '--skip-bids-validation', action='store_true',
-                    default=False,
-                    help='assume the input dataset is BIDS compliant and skip the validation')
-parser.add_argument('--processing_mode', '--processing-mode',
-                    choices=['hcp', 'legacy', 'auto'], default='hcp',
-                    help='Control HCP-Pipeline mode'
-                         'hcp (HCPStyleData): require T2w and fieldmap modalities'
-                         'legacy (LegacyStyleData): always ignore T2w and fieldmaps'
-                         'auto: use T2w and/or fieldmaps if available')
-parser.add_argument('--doslicetime', help="Apply slice timing correction as part of fMRIVolume.",
-                    action='store_true', default=False)
-parser.add_argument('--diffusion_output_name', help="Output base name for DiffusionPreprocessing.",
-                    default='Diffusion')
-parser.add_argument('--diffusion_eddy_no_gpu', help="Do NOT use GPU version of eddy during DiffusionPreprocessing.",
-                    action='store_true', default=False)
-parser.add_argument('--diffusion_eddy_args', help="String of extra args for eddy during DiffusionPreprocessing.",
-                    default='')
-parser.add_argument('--diffusion_usermatrix', help="Matrix file to use instead of registering output to T1w.",
-                    default='')
-args = parser.parse_args()
-
-
-if (args.gdcoeffs != 'NONE') and ('PreFreeSurfer' in args.stages) and (args.anat_unwarpdir == "NONE"):
-    raise AssertionError('--anat_unwarpdir must be specified to use PreFreeSurfer distortion correction')
-
-if not args.skip_bids_validation:
-    run("bids-validator " + args.bids_dir)
-
-layout = BIDSLayout(args.bids_dir, derivatives=False, absolute_paths=True)
-subjects_to_analyze = []
-# only for a subset of subjects
-if args.participant_label:
-    subjects_to_analyze = args.participant_label
-# for all subjects
-else:
-    subject_dirs = glob(os.path.join(args.bids_dir, "sub-*"))
-    subjects_to_analyze = [subject_dir.split("-")[-1] for subject_dir in subject_dirs]
-# only use a subset of sessions
-if args.session_label:
-    session_to_analyze = dict(session=args.session_label)
-else:
-    session_to_analyze = dict()
-
-# running participant level
-if args.analysis_level == "participant":
+    return run_checkpointed(cmd, args, env={"OMP_NUM_THREADS": str(args["n_cpus"])})
+
+# a node of the per-subject stage graph: the --stages name it belongs to, the
+# callable running it, the nodes it depends on, a message printed when it starts,
+# an optional concurrency group and the size of its input in voxels (times
+# timepoints), which its memory use is estimated from
+StageNode = namedtuple("StageNode", ["stage", "func", "depends", "message", "group", "input_voxels"],
+                       defaults=[None, None])
+
+def selected_depends(stage_graph, node):
+    # dependencies on stages that were not selected are replaced by their own
+    # dependencies, so e.g. fMRIVolume still waits for a selected PreFreeSurfer
+    depends = set()
+    for dep in stage_graph[node].depends:
+        if dep not in stage_graph:
+            continue
+        if stage_graph[dep].stage in args.stages:
+            depends.add(dep)
+        else:
+            depends |= selected_depends(stage_graph, dep)
+    return depends
+
+def all_depends(stage_graph, node):
+    depends = set()
+    for dep in stage_graph[node].depends:
+        if dep in stage_graph:
+            depends |= {dep} | all_depends(stage_graph, dep)
+    return depends
+
+def antichain_width(nodes, ancestors):
+    # the most of the nodes that can run at the same time: by Dilworth's
+    # theorem the fewest chains covering them, len(nodes) minus a maximum
+    # matching of each node to a later node in its chain
+    match = {}
+    def augment(node, seen):
+        for later in nodes:
+            if node in ancestors[later] and later not in seen:
+                seen.add(later)
+                if later not in match or augment(match[later], seen):
+                    match[later] = node
+                    return True
+        return False
+    return len(nodes) - sum(augment(node, set()) for node in nodes)
+
+def share_cpus(stage_graph, max_workers, group_limits={}):
+    # every node is given its n_cpus divided by the number of selected nodes
+    # that can run alongside it (neither depends on the other), so that
+    # overlapping stages do not oversubscribe the budget or, with --pin_cpus,
+    # wait for each other's cores
+    selected = [node for node, stage_node in stage_graph.items() if stage_node.stage in args.stages]
+    ancestors = {node: all_depends(stage_graph, node) for node in selected}
+    shared = OrderedDict()
+    for node, stage_node in stage_graph.items():
+        if node not in ancestors:
+            shared[node] = stage_node
+            continue
+        concurrent = [other for other in selected if other != node
+                      and other not in ancestors[node] and node not in ancestors[other]]
+        # a group limit caps how many of its members count
+        capped = antichain_width([other for other in concurrent
+                                  if stage_graph[other].group not in group_limits], ancestors)
+        for group, limit in group_limits.items():
+            members = [other for other in concurrent if stage_graph[other].group == group]
+            own = 1 if stage_node.group == group else 0
+            capped += min(max(0, limit - own), antichain_width(members, ancestors))
+        width = 1 + min(antichain_width(concurrent, ancestors), capped)
+        n_cpus = max(1, stage_node.func.keywords["n_cpus"] // min(width, max_workers))
+        shared[node] = stage_node._replace(func=partial(stage_node.func, n_cpus=n_cpus))
+    return shared
+
+# seconds between rewrites of a subject's status file while its stages run
+status_interval_s = 60
+
+def status_file(subject):
+    return os.path.join(args.output_dir, "status", subject + ".json")
+
+def estimate_remaining_s(stage_graph, states, max_workers, now):
+    # replays the scheduler with the estimated runtimes: a pending node starts
+    # once its dependencies are done and a worker is free
+    finish = {}
+    workers = []
+    for node, state in states.items():
+        if state["status"] == "running":
+            finish[node] = max(now, state["started"] + state["estimated_s"])
+            workers.append(finish[node])
+    workers += [now] * max(0, max_workers - len(workers))
+    for node, state in states.items():
+        if state["status"] != "pending":
+            continue
+        workers.sort()
+        start = max([workers[0]] + [finish.get(dep, now) for dep in selected_depends(stage_graph, node)])
+        finish[node] = workers[0] = start + state["estimated_s"]
+    return max(list(finish.values()) + [now]) - now
+
+def write_status(subject, stage_graph, states, max_workers, started, finished=None):
+    now = time.time()
+    remaining_s = 0 if finished else estimate_remaining_s(stage_graph, states, max_workers, now)
+    status = OrderedDict([("subject", subject),
+                          ("host", socket.gethostname()),
+                          ("pid", os.getpid()),
+                          ("started", started),
+                          ("updated", now),
+                          ("finished", finished),
+                          ("remaining_s", int(remaining_s)),
+                          ("eta", datetime.datetime.fromtimestamp(now + remaining_s).isoformat()),
+                          ("stages", states)])
+    target = status_file(subject)
+    Path(os.path.dirname(target)).mkdir(parents=True, exist_ok=True)
+    with open(target + ".tmp", "w") as fp:
+        json.dump(status, fp, indent=2)
+    os.replace(target + ".tmp", target)
+
+def format_duration(seconds):
+    minutes = int(seconds) // 60
+    if minutes >= 60:
+        return "%dh%02dm"%(minutes // 60, minutes % 60)
+    return "%dm"%minutes if minutes else "%ds"%int(seconds)
+
+def print_status():
+    # summary of the status files of the subjects processed in output_dir
+    statuses = []
+    for path in sorted(glob(status_file("*"))):
+        with open(path) as fp:
+            statuses.append(json.load(fp))
+    if not statuses:
+        print(f"No status files in {os.path.dirname(status_file(''))}")
+        return
+    now = time.time()
+    remaining = []
+    for status in statuses:
+        stages = status["stages"].values()
+        counts = {state: sum(stage["status"] == state for stage in stages)
+                  for state in ["done", "running", "failed", "skipped"]}
+        if status["finished"]:
+            state = "finished"
+        elif status["host"] == socket.gethostname() and not os.path.exists("/proc/%d"%status["pid"]):
+            state = "stopped"
+        else:
+            state = "running"
+            remaining.append(status["remaining_s"] - (now - status["updated"]))
+        line = "%-28s %-9s %d/%d stages done"%(status["subject"], state, counts["done"], len(stages))
+        if counts["failed"] or counts["skipped"]:
+            line += ", %d failed, %d skipped"%(counts["failed"], counts["skipped"])
+        if state == "running":
+            line += ", running: " + ", ".join("%s (%s of ~%s)"%(node, format_duration(now - stage["started"]),
+                                                               format_duration(stage["estimated_s"]))
+                                              for node, stage in status["stages"].items()
+                                              if stage["status"] == "running")
+            line += ", ETA %s"%status["eta"][:16]
+        print(line)
+    if remaining:
+        print("%d subject(s) running, the last is expected to finish in %s"%(
+              len(remaining), format_duration(max(0, max(remaining)))))
+
+def run_stage_graph(stage_graph, max_workers, group_limits={}, mem_gb=None):
+    stage_graph = share_cpus(stage_graph, max_workers, group_limits)
+    measured = measured_stage_usage(args.output_dir) if mem_gb else {}
+    pending = OrderedDict((node, selected_depends(stage_graph, node))
+                          for node, stage_node in stage_graph.items()
+                          if stage_node.stage in args.stages)
+    done = set()
+    failed = []
+    skipped = []
+    running = {}
+    reserved_gb = {}
+    # progress and estimated time to completion, from the stage history
+    history = runtime_history()
+    subject = next(iter(stage_graph.values())).func.keywords["subject"]
+    states = OrderedDict((node, OrderedDict([("stage", stage_graph[node].stage),
+                                             ("status", "pending"),
+                                             ("started", None),
+                                             ("finished", None),
+                                             ("estimated_s", estimate_runtime_s(
+                                                 stage_graph[node].stage,
+                                                 stage_graph[node].func.keywords["n_cpus"],
+                                                 stage_graph[node].input_voxels,
+                                                 history.get(stage_graph[node].stage)))]))
+                         for node in pending)
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # ready queue: start every runnable node in graph order, within limits
+            for node, depends in list(pending.items()):
+                failed_depends = depends.intersection(failed + skipped)
+                if failed_depends:
+                    print(f"BIDS App wrapper: skipping {node} because {', '.join(sorted(failed_depends))} did not complete")
+                    skipped.append(node)
+                    states[node]["status"] = "skipped"
+                    del pending[node]
+                    continue
+                if len(running) >= max_workers or not depends <= done:
+                    continue
+                group = stage_graph[node].group
+                if group in group_limits and \
+                   sum(stage_graph[n].group == group for n in running.values()) >= group_limits[group]:
+                    continue
+                # admission control: only start a stage when its estimated
+                # memory fits next to the running ones (or when it runs alone)
+                if mem_gb:
+                    node_gb = stage_memory_gb(stage_graph[node].stage, stage_graph[node].input_voxels, measured)
+                    if running and sum(reserved_gb.values()) + node_gb > mem_gb:
+                        continue
+                    if node_gb > mem_gb:
+                        print(f"BIDS App wrapper: {node} is estimated to need {node_gb:.1f} GB, "
+                              f"more than --mem_gb {mem_gb:g}, running it alone")
+                    reserved_gb[node] = node_gb
+                print(stage_graph[node].message)
+                force_stage = bool({"all", node, stage_graph[node].stage}.intersection(args.force_stages))
+                running[executor.submit(run_with_retries,
+                                        stage_graph[node].func,
+                                        stage_graph[node].stage,
+                                        stage_id=node,
+                                        stage_depends=sorted(all_depends(stage_graph, node)),
+                                        force_stage=force_stage,
+                                        input_voxels=stage_graph[node].input_voxels)] = node
+                states[node].update(status="running", started=time.time())
+                del pending[node]
+            write_status(subject, stage_graph, states, max_workers, started)
+            if not running:
+                break
+            finished, _ = wait(running, timeout=status_interval_s, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                reserved_gb.pop(node, None)
+                states[node]["finished"] = time.time()
+                try:
+                    future.result()
+                    done.add(node)
+                    states[node]["status"] = "done"
+                except Exception as e:
+                    print(f"BIDS App wrapper: {node} failed: {e}")
+                    failed.append(node)
+                    states[node]["status"] = "failed"
+    write_status(subject, stage_graph, states, max_workers, started, finished=time.time())
+    if failed:
+        raise Exception("%d stage(s) failed: %s%s"%(len(failed), ", ".join(failed),
+                        " (skipped dependent stages: %s)"%", ".join(skipped) if skipped else ""))
+
+def layout_signature(subject_label, ignore, sidecars=(".json",)):
+    # directory mtimes change whenever files are added, removed or renamed;
+    # sidecars are stat'ed as well since they can be edited in place
+    root = os.path.abspath(args.bids_dir)
+    signature = {"ignore": [getattr(patt, "pattern", patt) for patt in ignore],
+                 "paths": {}}
+    for entry in os.scandir(root):
+        if entry.is_file():
+            stat = entry.stat()
+            signature["paths"][entry.name] = [stat.st_size, stat.st_mtime_ns]
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, "sub-" + subject_label)):
+        signature["paths"][os.path.relpath(dirpath, root)] = os.stat(dirpath).st_mtime_ns
+        for f in filenames:
+            if f.endswith(sidecars):
+                stat = os.stat(os.path.join(dirpath, f))
+                signature["paths"][os.path.relpath(os.path.join(dirpath, f), root)] = \
+                    [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+def filter_tsv(src, dst, column, values):
+    with open(src) as fp:
+        lines = fp.read().splitlines()
+    index = lines[0].split("\t").index(column) if lines else 0
+    with open(dst, "w") as fp:
+        fp.writelines(line + "\n" for n, line in enumerate(lines)
+                      if n == 0 or line.split("\t")[index] in values)
+
+def validation_scope(scope_dir, subject_labels):
+    # a view of the dataset with only the participants (and sessions) being
+    # processed; the participant and session tables are cut down to match
+    root = os.path.abspath(args.bids_dir)
+    Path(scope_dir).mkdir(parents=True)
+    for entry in os.scandir(root):
+        if entry.name == "participants.tsv":
+            filter_tsv(entry.path, os.path.join(scope_dir, entry.name), "participant_id",
+                       ["sub-" + label for label in subject_labels])
+        elif not entry.name.startswith("sub-"):
+            os.symlink(entry.path, os.path.join(scope_dir, entry.name))
+    for label in subject_labels:
+        subject_dir = os.path.join(root, "sub-" + label)
+        if not args.session_label:
+            os.symlink(subject_dir, os.path.join(scope_dir, "sub-" + label))
+            continue
+        os.mkdir(os.path.join(scope_dir, "sub-" + label))
+        sessions = ["ses-" + ses for ses in args.session_label]
+        for entry in os.scandir(subject_dir):
+            target = os.path.join(scope_dir, "sub-" + label, entry.name)
+            if entry.name.endswith("_sessions.tsv"):
+                filter_tsv(entry.path, target, "session_id", sessions)
+            elif not entry.name.startswith("ses-") or entry.name in sessions:
+                os.symlink(entry.path, target)
+
+def validate_bids(subject_labels):
+    # validation results are kept per participant, keyed by the files of the
+    # participant and the top level of the dataset (see layout_signature), so
+    # repeated and concurrent jobs only validate what changed
+    cache_dir = os.path.join(args.output_dir, "bids_validation")
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    validator = shutil.which("bids-validator") or "bids-validator"
+    validator_stat = os.stat(validator) if os.path.exists(validator) else None
+    cache_files = {}
+    for label in subject_labels:
+        signature = layout_signature(label, [], sidecars=(".json", ".tsv", ".bval", ".bvec"))
+        signature.update({"sessions": args.session_label,
+                          "validator": [validator, validator_stat.st_mtime_ns if validator_stat else None]})
+        key = hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+        cache_files[label] = os.path.join(cache_dir, key + ".json")
+    pending = [label for label in subject_labels if not os.path.exists(cache_files[label])]
+    if not pending:
+        print(f"BIDS App wrapper: {len(subject_labels)} participant(s) were validated before "
+              "and did not change, skipping validation")
+        return
+
+    print(f"BIDS App wrapper: validating {len(pending)} of {len(subject_labels)} participant(s)")
+    scope_dir = os.path.join(cache_dir, "scope_%d"%os.getpid())
+    if os.path.lexists(scope_dir):
+        rmtree(scope_dir)
+    try:
+        validation_scope(scope_dir, pending)
+        run("bids-validator " + scope_dir)
+    finally:
+        rmtree(scope_dir)
+    for label in pending:
+        with open(cache_files[label] + ".tmp", "w") as fp:
+            json.dump({"participant": label, "sessions": args.session_label,
+                       "validated": datetime.datetime.now().isoformat()}, fp)
+        os.replace(cache_files[label] + ".tmp", cache_files[label])
+
+# indexes of participants kept by a --worker, least recently used first
+worker_layouts = OrderedDict()
+worker_layouts_size = 16
+
+def subject_layout(subject_label):
+    if dataset_layout is not None:
+        return dataset_layout
+
+    # index the top level of the dataset (for inherited metadata) and this
+    # participant only
+    root = re.escape(os.path.abspath(args.bids_dir))
+    ignore = ["code", "stimuli", "sourcedata", "models", re.compile(r'^\.'),
+              re.compile(r"^%s/sub-(?!%s(/|$))"%(root, re.escape(subject_label)))]
+    if args.session_label and args.bids_index_sessions_only:
+        ignore.append(re.compile(r"^%s/sub-%s/ses-(?!(%s)(/|$))"%(root, re.escape(subject_label),
+                                 "|".join(re.escape(ses) for ses in args.session_label))))
+
+    if not args.worker:
+        return index_subject(subject_label, ignore)
+    # workers keep the indexes of recently processed participants while their
+    # files do not change
+    signature = layout_signature(subject_label, ignore)
+    if subject_label in worker_layouts and worker_layouts[subject_label][0] == signature:
+        worker_layouts.move_to_end(subject_label)
+        return worker_layouts[subject_label][1]
+    layout = index_subject(subject_label, ignore)
+    worker_layouts[subject_label] = (signature, layout)
+    while len(worker_layouts) > worker_layouts_size:
+        worker_layouts.popitem(last=False)
+    return layout
+
+def index_subject(subject_label, ignore):
+    if not args.bids_database_dir:
+        return BIDSLayout(args.bids_dir, derivatives=False, absolute_paths=True, ignore=ignore)
+
+    database_path = os.path.join(os.path.abspath(args.bids_database_dir), f"sub-{subject_label}")
+    signature_file = os.path.join(database_path, "layout_signature.json")
+    Path(database_path).mkdir(parents=True, exist_ok=True)
+    # concurrent jobs for the same participant wait for a single (re)index
+    with open(database_path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        signature = layout_signature(subject_label, ignore)
+        try:
+            with open(signature_file) as fp:
+                reset_database = json.load(fp) != signature
+        except (IOError, ValueError):
+            reset_database = True
+        if reset_database:
+            print(f"BIDS App wrapper: indexing sub-{subject_label} into {database_path}")
+            if os.path.exists(signature_file):
+                os.remove(signature_file)
+        layout = BIDSLayout(os.path.abspath(args.bids_dir), derivatives=False, absolute_paths=True,
+                            ignore=ignore, database_path=database_path,
+                            reset_database=reset_database)
+        if reset_database:
+            with open(signature_file + ".tmp", "w") as fp:
+                json.dump(signature, fp)
+            os.replace(signature_file + ".tmp", signature_file)
+    return layout
+
+# shape and zooms of NIfTI images keyed by path, validated by size and mtime
+nifti_header_cache = {}
+nifti_header_cache_lock = threading.Lock()
+
+def nifti_header(path):
+    # only the header bytes are read (and decompressed), not the image data
+    stat = os.stat(path)
+    with nifti_header_cache_lock:
+        cached = nifti_header_cache.get(path)
+    if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+        return cached
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as fp:
+        raw = fp.read(540)
+    if 540 in (int.from_bytes(raw[:4], "little"), int.from_bytes(raw[:4], "big")):
+        header = nibabel.Nifti2Header(raw[:540], check=False)
+    else:
+        header = nibabel.Nifti1Header(raw[:348], check=False)
+    cached = {"size": stat.st_size,
+              "mtime": stat.st_mtime_ns,
+              "shape": [int(x) for x in header.get_data_shape()],
+              "zooms": [float(x) for x in header.get_zooms()]}
+    with nifti_header_cache_lock:
+        nifti_header_cache[path] = cached
+    return cached
+
+def prefetch_nifti_headers(paths, max_workers=8):
+    paths = sorted(set(paths))
+    if paths:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+            list(executor.map(nifti_header, paths))
+
+def load_nifti_header_cache(cache_file):
+    try:
+        with open(cache_file) as fp:
+            cached = json.load(fp)
+    except (IOError, ValueError):
+        return []
+    with nifti_header_cache_lock:
+        for path, header in cached.items():
+            nifti_header_cache.setdefault(path, header)
+    return list(cached)
+
+def save_nifti_header_cache(cache_file, paths):
+    with nifti_header_cache_lock:
+        cached = {path: nifti_header_cache[path] for path in paths if path in nifti_header_cache}
+    tmp = "%s.tmp%d_%d"%(cache_file, os.getpid(), threading.get_ident())
+    with open(tmp, "w") as fp:
+        json.dump(cached, fp)
+    os.replace(tmp, cache_file)
+
+# the index of the whole dataset is shared by the threads of the preflight,
+# its database session must only be used by one of them at a time
+dataset_layout_lock = threading.RLock()
+
+class CachedLayout(object):
+    # memoizes metadata and fieldmap lookups, which otherwise re-walk the
+    # sidecar inheritance chain on every call
+    def __init__(self, layout):
+        self.layout = layout
+        self.metadata = {}
+        self.fieldmaps = {}
+        self.lock = dataset_layout_lock if layout is dataset_layout else nullcontext()
+
+    def __getattr__(self, name):
+        # everything else is passed through, under the same lock: the session
+        # of a shared BIDSLayout is not thread-safe
+        attribute = getattr(self.layout, name)
+        if not callable(attribute):
+            return attribute
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+    def get(self, **kwargs):
+        with self.lock:
+            return self.layout.get(**kwargs)
+
+    def get_metadata(self, path):
+        if path not in self.metadata:
+            with self.lock:
+                self.metadata[path] = self.layout.get_metadata(path)
+        return self.metadata[path]
+
+    def get_fieldmap(self, path, return_list=False):
+        if (path, return_list) not in self.fieldmaps:
+            with self.lock:
+                self.fieldmaps[(path, return_list)] = self.layout.get_fieldmap(path, return_list=return_list)
+        return self.fieldmaps[(path, return_list)]
+
+def unit_subject(subject_label, session_label=None):
+    # the output subject ID of a participant, or of one of its sessions that
+    # is processed on its own (--per_session)
+    return f"sub-{subject_label}_ses-{session_label}" if session_label else f"sub-{subject_label}"
+
+def subject_tmp_dir(subject):
+    # the intermediates run.py creates for the stages of a subject
+    return f"{args.output_dir}/tmp/{subject[len('sub-'):]}"
+
+def plan_subject(subject_label, layout, session_label=None):
+    # resolves every acquisition parameter of a participant up front; the plan
+    # only contains plain types so that it can be exported as JSON
+    layout = CachedLayout(layout)
+    plan = OrderedDict([("subject", unit_subject(subject_label, session_label)),
+                        ("subject_label", subject_label),
+                        ("session_label", session_label)])
+    sessions = dict(session=session_label) if session_label else session_to_analyze
+    # a session on its own only borrows the anatomicals of the others on request
+    other_sessions_anat = not session_label or args.per_session_shared_anat
+
+    # read the headers of all images the plan may need in parallel, reusing
+    # the ones cached next to the participant's index by earlier runs
+    header_cache_file = None
+    cached_images = []
+    if args.bids_database_dir:
+        header_cache_file = os.path.join(os.path.abspath(args.bids_database_dir),
+                                         f"sub-{subject_label}", "nifti_headers.json")
+        cached_images = load_nifti_header_cache(header_cache_file)
+    images = [f.path for f in layout.get(subject=subject_label,
+                                         suffix=['T1w', 'T2w', 'bold', 'epi', 'dwi'],
+                                         extensions=["nii.gz", "nii"],
+                                         **sessions)]
+    prefetch_nifti_headers(images)
+    if header_cache_file:
+        # keeping the headers of the participant's other sessions
+        save_nifti_header_cache(header_cache_file, cached_images + images)
+
     # find all T1s and skullstrip them
-    for subject_label in subjects_to_analyze:
+    t1ws = [f.path for f in layout.get(subject=subject_label,
+                                           suffix='T1w',
+                                           extensions=["nii.gz", "nii"],
+                                           **sessions)]
+    if len(t1ws) == 0 and other_sessions_anat:
         t1ws = [f.path for f in layout.get(subject=subject_label,
                                                suffix='T1w',
-                                               extensions=["nii.gz", "nii"],
-                                               **session_to_analyze)]
-        if len(t1ws) == 0:
-            t1ws = [f.path for f in layout.get(subject=subject_label,
-                                                   suffix='T1w',
-                                                   extensions=["nii.gz", "nii"])]
-        assert (len(t1ws) > 0), "No T1w files found for subject %s!"%subject_label
-
-        available_resolutions = ["0.7", "0.8", "1"]
-        t1_zooms = nibabel.load(t1ws[0]).header.get_zooms()
-        t1_res = float(min(t1_zooms[:3]))
-        t1_template_res = min(available_resolutions, key=lambda x:abs(float(x)-t1_res))
-        t1_spacing = layout.get_metadata(t1ws[0])["DwellTime"]
+                                               extensions=["nii.gz", "nii"])]
+    assert (len(t1ws) > 0), "No T1w files found for subject %s%s!"%(
+        subject_label, f" in session {session_label} (see --per_session_shared_anat)" if session_label else "")
 
+    available_resolutions = ["0.7", "0.8", "1"]
+    t1_zooms = nifti_header(t1ws[0])["zooms"]
+    t1_res = float(min(t1_zooms[:3]))
+    t1_template_res = min(available_resolutions, key=lambda x:abs(float(x)-t1_res))
+    t1_spacing = layout.get_metadata(t1ws[0])["DwellTime"]
+
+    t2ws = [f.path for f in layout.get(subject=subject_label,
+                        suffix='T2w',
+                        extensions=["nii.gz", "nii"],
+                        **sessions)]
+    if len(t2ws) == 0 and other_sessions_anat:
         t2ws = [f.path for f in layout.get(subject=subject_label,
-                            suffix='T2w',
-                            extensions=["nii.gz", "nii"],
-                            **session_to_analyze)]
-        if len(t2ws) == 0:
-            t2ws = [f.path for f in layout.get(subject=subject_label,
-                                                   suffix='T2w',
-                                                   extensions=["nii.gz", "nii"])]
-        if (len(t2ws) > 0) and ( args.processing_mode != 'legacy'):
-            t2_zooms = nibabel.load(t2ws[0]).header.get_zooms()
-            t2_res = float(min(t2_zooms[:3]))
-            t2_template_res = min(available_resolutions, key=lambda x: abs(float(x) - t2_res))
-            t2_spacing = layout.get_metadata(t2ws[0])["DwellTime"]
-            anat_processing_mode = "HCPStyleData"
+                                               suffix='T2w',
+                                               extensions=["nii.gz", "nii"])]
+    if (len(t2ws) > 0) and ( args.processing_mode != 'legacy'):
+        t2_zooms = nifti_header(t2ws[0])["zooms"]
+        t2_res = float(min(t2_zooms[:3]))
+        t2_template_res = min(available_resolutions, key=lambda x: abs(float(x) - t2_res))
+        t2_spacing = layout.get_metadata(t2ws[0])["DwellTime"]
+        anat_processing_mode = "HCPStyleData"
 
-        else:
-            assert (args.processing_mode != 'hcp'), \
-                f"No T2w files found for sub-{subject_label}. Consider --procesing_mode [legacy | auto ]."
-
-            t2ws = "NONE"
-            t2_template_res = "NONE"
-            t2_spacing = "NONE"
-            anat_processing_mode = "LegacyStyleData"
-
-        # parse fieldmaps for structural processing
-        fieldmap_set = layout.get_fieldmap(t1ws[0], return_list=True)
-        fmap_args = {"fmapmag": "NONE",
-                     "fmapphase": "NONE",
-                     "echodiff": "NONE",
-                     "t1samplespacing": "NONE",
-                     "t2samplespacing": "NONE",
-                     "unwarpdir": "NONE",
-                     "avgrdcmethod": "NONE",
-                     "SEPhaseNeg": "NONE",
-                     "SEPhasePos": "NONE",
-                     "echospacing": "NONE",
-                     "seunwarpdir": "NONE"}
-
-        if fieldmap_set and ( args.processing_mode != 'legacy' ):
-
-            # use an unwarpdir specified on the command line
-            # this is different from the SE direction
-            unwarpdir = args.anat_unwarpdir
-
-            fmap_args.update({"t1samplespacing": "%.8f"%t1_spacing,
-                              "t2samplespacing": "%.8f"%t2_spacing,
-                              "unwarpdir": unwarpdir})
-
-            if fieldmap_set[0]["suffix"] == "phasediff":
-                merged_file = "%s/tmp/%s/magfile.nii.gz"%(args.output_dir, subject_label)
-                run("mkdir -p %s/tmp/%s/ && fslmerge -t %s %s %s"%(args.output_dir,
-                subject_label,
-                merged_file,
-                fieldmap_set["magnitude1"],
-                fieldmap_set["magnitude2"]))
-
-                phasediff_metadata = layout.get_metadata(fieldmap_set["phasediff"])
-                te_diff = phasediff_metadata["EchoTime2"] - phasediff_metadata["EchoTime1"]
-                # HCP expects TE in miliseconds
-                te_diff = te_diff*1000.0
-
-                fmap_args.update({"fmapmag": merged_file,
-                                  "fmapphase": fieldmap_set["phasediff"],
-                                  "echodiff": "%.6f"%te_diff,
-                                  "avgrdcmethod": "SiemensFieldMap"})
-            elif fieldmap_set[0]["suffix"] == "epi":
-                SEPhaseNeg = None
-                SEPhasePos = None
-                for fieldmap in fieldmap_set:
-                    enc_dir = layout.get_metadata(fieldmap['epi'])["PhaseEncodingDirection"]
-                    if "-" in enc_dir:
-                        SEPhaseNeg = fieldmap['epi']
-                    else:
-                        SEPhasePos = fieldmap['epi']
-
-                seunwarpdir = layout.get_metadata(fieldmap_set[0]["epi"])["PhaseEncodingDirection"]
-                seunwarpdir = seunwarpdir.replace("-", "").replace("i","x").replace("j", "y").replace("k", "z")
-
-                #TODO check consistency of echo spacing instead of assuming it's all the same
-                if "EffectiveEchoSpacing" in layout.get_metadata(fieldmap_set[0]["epi"]):
-                    echospacing = layout.get_metadata(fieldmap_set[0]["epi"])["EffectiveEchoSpacing"]
-                elif "TotalReadoutTime" in layout.get_metadata(fieldmap_set["epi"][0]):
-                    # HCP Pipelines do not allow users to specify total readout time directly
-                    # Hence we need to reverse the calculations to provide echo spacing that would
-                    # result in the right total read out total read out time
-                    # see https://github.com/Washington-University/Pipelines/blob/master/global/scripts/TopupPreprocessingAll.sh#L202
-                    print("BIDS App wrapper: Did not find EffectiveEchoSpacing, calculating it from TotalReadoutTime")
-                    # TotalReadoutTime = EffectiveEchoSpacing * (len(PhaseEncodingDirection) - 1)
-                    total_readout_time = layout.get_metadata(fieldmap_set[0]["epi"])["TotalReadoutTime"]
-                    phase_len = nibabel.load(fieldmap_set[0]["epi"]).shape[{"x": 0, "y": 1}[seunwarpdir]]
-                    echospacing = total_readout_time / float(phase_len - 1)
+    else:
+        assert (args.processing_mode != 'hcp'), \
+            f"No T2w files found for sub-{subject_label}. Consider --procesing_mode [legacy | auto ]."
+
+        t2ws = "NONE"
+        t2_template_res = "NONE"
+        t2_spacing = "NONE"
+        anat_processing_mode = "LegacyStyleData"
+
+    # parse fieldmaps for structural processing
+    fieldmap_set = layout.get_fieldmap(t1ws[0], return_list=True)
+    fmap_args = {"fmapmag": "NONE",
+                 "fmapphase": "NONE",
+                 "echodiff": "NONE",
+                 "t1samplespacing": "NONE",
+                 "t2samplespacing": "NONE",
+                 "unwarpdir": "NONE",
+                 "avgrdcmethod": "NONE",
+                 "SEPhaseNeg": "NONE",
+                 "SEPhasePos": "NONE",
+                 "echospacing": "NONE",
+                 "seunwarpdir": "NONE"}
+    magnitudes = None
+
+    if fieldmap_set and ( args.processing_mode != 'legacy' ):
+
+        # use an unwarpdir specified on the command line
+        # this is different from the SE direction
+        unwarpdir = args.anat_unwarpdir
+
+        fmap_args.update({"t1samplespacing": "%.8f"%t1_spacing,
+                          "t2samplespacing": "%.8f"%t2_spacing,
+                          "unwarpdir": unwarpdir})
+
+        if fieldmap_set[0]["suffix"] == "phasediff":
+            # the magnitudes are merged by prepare_subject()
+            merged_file = "%s/magfile.nii.gz"%subject_tmp_dir(plan["subject"])
+            magnitudes = [fieldmap_set[0]["magnitude1"], fieldmap_set[0]["magnitude2"]]
+
+            phasediff_metadata = layout.get_metadata(fieldmap_set[0]["phasediff"])
+            te_diff = phasediff_metadata["EchoTime2"] - phasediff_metadata["EchoTime1"]
+            # HCP expects TE in miliseconds
+            te_diff = te_diff*1000.0
+
+            fmap_args.update({"fmapmag": merged_file,
+                              "fmapphase": fieldmap_set[0]["phasediff"],
+                              "echodiff": "%.6f"%te_diff,
+                              "avgrdcmethod": "SiemensFieldMap"})
+        elif fieldmap_set[0]["suffix"] == "epi":
+            SEPhaseNeg = None
+            SEPhasePos = None
+            for fieldmap in fieldmap_set:
+                enc_dir = layout.get_metadata(fieldmap['epi'])["PhaseEncodingDirection"]
+                if "-" in enc_dir:
+                    SEPhaseNeg = fieldmap['epi']
                 else:
-                    raise RuntimeError("EffectiveEchoSpacing or TotalReadoutTime not defined for the fieldmap intended for T1w image. Please fix your BIDS dataset.")
-
-                fmap_args.update({"SEPhaseNeg": SEPhaseNeg,
-                                  "SEPhasePos": SEPhasePos,
-                                  "echospacing": "%.6f"%echospacing,
-                                  "seunwarpdir": seunwarpdir,
-                                  "avgrdcmethod": "TOPUP"})
-        #TODO add support for GE fieldmaps
-
-        struct_stages_dict = OrderedDict([("PreFreeSurfer", partial(run_pre_freesurfer,
-                                                path=args.output_dir,
-                                                subject="sub-%s"%subject_label,
-                                                t1ws=t1ws,
-                                                t2ws=t2ws,
-                                                n_cpus=args.n_cpus,
-                                                t1_template_res=t1_template_res,
-                                                t2_template_res=t2_template_res,
-                                                gdcoeffs=args.gdcoeffs,
-                                                processing_mode=anat_processing_mode,
-                                                **fmap_args)),
-                       ("FreeSurfer", partial(run_freesurfer,
-                                             path=args.output_dir,
-                                             subject="sub-%s"%subject_label,
-                                             n_cpus=args.n_cpus,
-                                             processing_mode=anat_processing_mode)),
-                       ("PostFreeSurfer", partial(run_post_freesurfer,
-                                                 path=args.output_dir,
-                                                 subject="sub-%s"%subject_label,
-                                                 grayordinatesres=grayordinatesres,
-                                                 lowresmesh=lowresmesh,
-                                                 n_cpus=args.n_cpus,
-                                                 regname=args.coreg,
-                                                 processing_mode=anat_processing_mode))
-                       ])
-        for stage, stage_func in struct_stages_dict.items():
-            if stage in args.stages:
-                print(f'{stage} in {anat_processing_mode} mode')
-                stage_func()
-
-        bolds = [f.path for f in layout.get(subject=subject_label,
-                                                suffix='bold',
-                                                extensions=["nii.gz", "nii"],
-                                                **session_to_analyze)]
-        for fmritcs in bolds:
-            fmriname = "_".join(fmritcs.split("sub-")[-1].split("_")[1:]).split(".")[0]
-            assert fmriname
-
-            fmriscout = fmritcs.replace("_bold", "_sbref")
-            if not os.path.exists(fmriscout):
-                fmriscout = "NONE"
-
-            fieldmap_set = layout.get_fieldmap(fmritcs, return_list=True)
-            if fieldmap_set and len(fieldmap_set) == 2 and all(item["suffix"] == "epi" for item in fieldmap_set) and ( args.processing_mode != 'legacy' ):
-                SEPhaseNeg = None
-                SEPhasePos = None
-                for fieldmap in fieldmap_set:
-                    enc_dir = layout.get_metadata(fieldmap["epi"])["PhaseEncodingDirection"]
-                    if "-" in enc_dir:
-                        SEPhaseNeg = fieldmap['epi']
-                    else:
-                        SEPhasePos = fieldmap['epi']
-                echospacing = layout.get_metadata(fmritcs)["EffectiveEchoSpacing"]
-                unwarpdir = layout.get_metadata(fmritcs)["PhaseEncodingDirection"]
-                unwarpdir = unwarpdir.replace("i","x").replace("j", "y").replace("k", "z")
-                if len(unwarpdir) == 2:
-                    unwarpdir = "-" + unwarpdir[0]
-                dcmethod = "TOPUP"
-                biascorrection = "SEBASED"
-                func_processing_mode = "HCPStyleData"
+                    SEPhasePos = fieldmap['epi']
+
+            seunwarpdir = layout.get_metadata(fieldmap_set[0]["epi"])["PhaseEncodingDirection"]
+            seunwarpdir = seunwarpdir.replace("-", "").replace("i","x").replace("j", "y").replace("k", "z")
+
+            #TODO check consistency of echo spacing instead of assuming it's all the same
+            if "EffectiveEchoSpacing" in layout.get_metadata(fieldmap_set[0]["epi"]):
+                echospacing = layout.get_metadata(fieldmap_set[0]["epi"])["EffectiveEchoSpacing"]
+            elif "TotalReadoutTime" in layout.get_metadata(fieldmap_set[0]["epi"]):
+                # HCP Pipelines do not allow users to specify total readout time directly
+                # Hence we need to reverse the calculations to provide echo spacing that would
+                # result in the right total read out total read out time
+                # see https://github.com/Washington-University/Pipelines/blob/master/global/scripts/TopupPreprocessingAll.sh#L202
+                print("BIDS App wrapper: Did not find EffectiveEchoSpacing, calculating it from TotalReadoutTime")
+                # TotalReadoutTime = EffectiveEchoSpacing * (len(PhaseEncodingDirection) - 1)
+                total_readout_time = layout.get_metadata(fieldmap_set[0]["epi"])["TotalReadoutTime"]
+                phase_len = nifti_header(fieldmap_set[0]["epi"])["shape"][{"x": 0, "y": 1}[seunwarpdir]]
+                echospacing = total_readout_time / float(phase_len - 1)
             else:
-                assert (args.processing_mode != 'hcp'), \
-                    f"No fieldmaps found for BOLD {fmritcs}. Consider --procesing_mode [legacy | auto ]."
-
-                SEPhaseNeg = "NONE"
-                SEPhasePos = "NONE"
-                echospacing = "NONE"
-                unwarpdir = "NONE"
-                dcmethod = "NONE"
-                biascorrection = "NONE"
-                func_processing_mode = "LegacyStyleData"
-
-            zooms = nibabel.load(fmritcs).header.get_zooms()
-            fmrires = float(min(zooms[:3]))
-            fmrires = "2" # https://github.com/Washington-University/Pipelines/blob/637b35f73697b77dcb1d529902fc55f431f03af7/fMRISurface/scripts/SubcorticalProcessing.sh#L43
-            # While running '/usr/bin/wb_command -cifti-create-dense-timeseries /scratch/users/chrisgor/hcp_output2/sub-100307/MNINonLinear/Results/EMOTION/EMOTION_temp_subject.dtseries.nii -volume /scratch/users/chrisgor/hcp_output2/sub-100307/MNINonLinear/Results/EMOTION/EMOTION.nii.gz /scratch/users/chrisgor/hcp_output2/sub-100307/MNINonLinear/ROIs/ROIs.2.nii.gz':
-            # ERROR: label volume has a different volume space than data volume
-
-            # optional slice timing
-            doslicetime = "FALSE"
-            slicetimerparams = ""
-            if args.doslicetime:
-                doslicetime = "TRUE"
-                func_processing_mode = "LegacyStyleData"
-                try:
-                    slicetiming = layout.get_metadata(fmritcs)["SliceTiming"]
-                    tr = layout.get_metadata(fmritcs)["RepetitionTime"]
-                except KeyError:
-                    print(f"SliceTiming metadata is required for slice timing correction of {fmritcs}")
+                raise RuntimeError("EffectiveEchoSpacing or TotalReadoutTime not defined for the fieldmap intended for T1w image. Please fix your BIDS dataset.")
 
-                try:
-                    slicedirection = layout.get_metadata(fmritcs)["SliceEncodingDirection"]
-                    if '-' in slicedirection:
-                        slicetiming.reverse()
-                except KeyError:
-                    pass
+            fmap_args.update({"SEPhaseNeg": SEPhaseNeg,
+                              "SEPhasePos": SEPhasePos,
+                              "echospacing": "%.6f"%echospacing,
+                              "seunwarpdir": seunwarpdir,
+                              "avgrdcmethod": "TOPUP"})
+    #TODO add support for GE fieldmaps
+
+    plan["anat"] = OrderedDict([("t1ws", t1ws),
+                                ("t2ws", t2ws),
+                                ("t1_template_res", t1_template_res),
+                                ("t2_template_res", t2_template_res),
+                                ("processing_mode", anat_processing_mode),
+                                ("magnitudes", magnitudes),
+                                ("fmap_args", fmap_args)])
+
+    bolds = [f.path for f in layout.get(subject=subject_label,
+                                            suffix='bold',
+                                            extensions=["nii.gz", "nii"],
+                                            **sessions)]
+    plan["bolds"] = []
+    for fmritcs in bolds:
+        fmriname = "_".join(fmritcs.split("sub-")[-1].split("_")[1:]).split(".")[0]
+        assert fmriname
+
+        fmriscout = fmritcs.replace("_bold", "_sbref")
+        if not os.path.exists(fmriscout):
+            fmriscout = "NONE"
+
+        fieldmap_set = layout.get_fieldmap(fmritcs, return_list=True)
+        if fieldmap_set and len(fieldmap_set) == 2 and all(item["suffix"] == "epi" for item in fieldmap_set) and ( args.processing_mode != 'legacy' ):
+            SEPhaseNeg = None
+            SEPhasePos = None
+            for fieldmap in fieldmap_set:
+                enc_dir = layout.get_metadata(fieldmap["epi"])["PhaseEncodingDirection"]
+                if "-" in enc_dir:
+                    SEPhaseNeg = fieldmap['epi']
+                else:
+                    SEPhasePos = fieldmap['epi']
+            echospacing = layout.get_metadata(fmritcs)["EffectiveEchoSpacing"]
+            unwarpdir = layout.get_metadata(fmritcs)["PhaseEncodingDirection"]
+            unwarpdir = unwarpdir.replace("i","x").replace("j", "y").replace("k", "z")
+            if len(unwarpdir) == 2:
+                unwarpdir = "-" + unwarpdir[0]
+            dcmethod = "TOPUP"
+            biascorrection = "SEBASED"
+            func_processing_mode = "HCPStyleData"
+        else:
+            assert (args.processing_mode != 'hcp'), \
+                f"No fieldmaps found for BOLD {fmritcs}. Consider --procesing_mode [legacy | auto ]."
+
+            SEPhaseNeg = "NONE"
+            SEPhasePos = "NONE"
+            echospacing = "NONE"
+            unwarpdir = "NONE"
+            dcmethod = "NONE"
+            biascorrection = "NONE"
+            func_processing_mode = "LegacyStyleData"
+
+        zooms = nifti_header(fmritcs)["zooms"]
+        fmrires = float(min(zooms[:3]))
+        fmrires = "2" # https://github.com/Washington-University/Pipelines/blob/637b35f73697b77dcb1d529902fc55f431f03af7/fMRISurface/scripts/SubcorticalProcessing.sh#L43
+        # While running '/usr/bin/wb_command -cifti-create-dense-timeseries /scratch/users/chrisgor/hcp_output2/sub-100307/MNINonLinear/Results/EMOTION/EMOTION_temp_subject.dtseries.nii -volume /scratch/users/chrisgor/hcp_output2/sub-100307/MNINonLinear/Results/EMOTION/EMOTION.nii.gz /scratch/users/chrisgor/hcp_output2/sub-100307/MNINonLinear/ROIs/ROIs.2.nii.gz':
+        # ERROR: label volume has a different volume space than data volume
+
+        # optional slice timing, the timing file is written by prepare_subject()
+        doslicetime = "FALSE"
+        slicetimerparams = ""
+        slicetiming = None
+        if args.doslicetime:
+            doslicetime = "TRUE"
+            func_processing_mode = "LegacyStyleData"
+            try:
+                slicetiming = layout.get_metadata(fmritcs)["SliceTiming"]
+                tr = layout.get_metadata(fmritcs)["RepetitionTime"]
+            except KeyError:
+                raise RuntimeError(f"SliceTiming metadata is required for slice timing correction of {fmritcs}")
 
-                # shift timing to the median slice, assuming equally spaced slices
-                slicedelta = np.diff(np.sort(slicetiming))
-                slicedelta = np.mean(slicedelta[slicedelta > 0])
-                slicetiming = slicetiming / (np.max(slicetiming) + slicedelta)
-                slicetiming = -(slicetiming - np.median(slicetiming))
-
-                tmpdir = f"{args.output_dir}/tmp/{subject_label}"
-                Path(tmpdir).mkdir(parents=True, exist_ok=True)
-                with open(f"{tmpdir}/{fmriname}_st.txt", "w") as fp:
-                    fp.writelines("%f\n" % t for t in slicetiming)
-
-                slicetimerparams = f"--repeat={tr}@--tcustom={tmpdir}/{fmriname}_st.txt"
-
-            func_stages_dict = OrderedDict([("fMRIVolume", partial(run_generic_fMRI_volume_processsing,
-                                                      path=args.output_dir,
-                                                      subject="sub-%s"%subject_label,
-                                                      fmriname=fmriname,
-                                                      fmritcs=fmritcs,
-                                                      fmriscout=fmriscout,
-                                                      SEPhaseNeg=SEPhaseNeg,
-                                                      SEPhasePos=SEPhasePos,
-                                                      echospacing=echospacing,
-                                                      unwarpdir=unwarpdir,
-                                                      fmrires=fmrires,
-                                                      dcmethod=dcmethod,
-                                                      biascorrection=biascorrection,
-                                                      n_cpus=args.n_cpus,
-                                                      gdcoeffs=args.gdcoeffs,
-                                                      doslicetime=doslicetime,
-                                                      slicetimerparams=slicetimerparams,
-                                                      processing_mode=func_processing_mode)),
-                                ("fMRISurface", partial(run_generic_fMRI_surface_processsing,
-                                                       path=args.output_dir,
-                                                       subject="sub-%s"%subject_label,
-                                                       fmriname=fmriname,
-                                                       fmrires=fmrires,
-                                                       n_cpus=args.n_cpus,
-                                                       grayordinatesres=grayordinatesres,
-                                                       lowresmesh=lowresmesh,
-                                                       regname=args.coreg))
-                                ])
-            for stage, stage_func in func_stages_dict.items():
-                if stage in args.stages:
-                    print(f"Processing {fmritcs} in {func_processing_mode} mode.")
-                    stage_func()
-
-        dwis=[f.path for f in layout.get(subject=subject_label,
-                                                       suffix='dwi',
-                                                       extensions=["nii.gz", "nii"],**session_to_analyze)]
-                                                       
-        
-        pos = []; neg = []
-        PEdir = None; echospacing = None
-        dwi_jsonfile=None
-        
-        for idx,dwi in enumerate(dwis):
-            metadata = layout.get_metadata(dwi)
-            
-            #get metadata json file path so we can pass it to the eddy command
-            dwi_file_entities=layout.parse_file_entities(dwi)
-            dwi_file_entities['extension']='json'
             try:
-                metadata_jsonfile=layout.get(**dwi_file_entities)
-                if len(metadata_jsonfile)>0:
-                    dwi_jsonfile=metadata_jsonfile[0].path
-            except:
+                slicedirection = layout.get_metadata(fmritcs)["SliceEncodingDirection"]
+                if '-' in slicedirection:
+                    slicetiming = list(reversed(slicetiming))
+            except KeyError:
                 pass
-            
-            # get phaseencodingdirection
-            phaseenc = metadata['PhaseEncodingDirection']
-            
-            acq = 1 if 'i' in phaseenc else 2
-            if not PEdir:
-                PEdir = acq
-            if PEdir != acq:
-                raise RuntimeError("Not all dwi images have the same encoding direction (both LR and AP). Not implemented.")
-            # get pos/neg
-            if "-" in phaseenc:
-                neg.append(dwi)
-            else:
-                pos.append(dwi)
-            # get echospacing
-            if not echospacing:
-                echospacing = metadata['EffectiveEchoSpacing']*1000.
-            if echospacing != metadata['EffectiveEchoSpacing']*1000.:
-                raise RuntimeError("Not all dwi images have the same echo spacing. Not implemented.")
-
-        posdata = "@".join(pos)
-        negdata = "@".join(neg)
-
-        if dwi_jsonfile:
-            args.diffusion_eddy_args += f" --json={dwi_jsonfile}"
+
+            # shift timing to the median slice, assuming equally spaced slices
+            slicedelta = np.diff(np.sort(slicetiming))
+            slicedelta = np.mean(slicedelta[slicedelta > 0])
+            slicetiming = slicetiming / (np.max(slicetiming) + slicedelta)
+            slicetiming = -(slicetiming - np.median(slicetiming))
+            slicetiming = slicetiming.tolist()
+
+            tmpdir = subject_tmp_dir(plan["subject"])
+            slicetimerparams = f"--repeat={tr}@--tcustom={tmpdir}/{fmriname}_st.txt"
+
+        plan["bolds"].append(OrderedDict([("fmriname", fmriname),
+                                          ("fmritcs", fmritcs),
+                                          ("fmriscout", fmriscout),
+                                          ("SEPhaseNeg", SEPhaseNeg),
+                                          ("SEPhasePos", SEPhasePos),
+                                          ("echospacing", echospacing),
+                                          ("unwarpdir", unwarpdir),
+                                          ("fmrires", fmrires),
+                                          ("dcmethod", dcmethod),
+                                          ("biascorrection", biascorrection),
+                                          ("doslicetime", doslicetime),
+                                          ("slicetiming", slicetiming),
+                                          ("slicetimerparams", slicetimerparams),
+                                          ("processing_mode", func_processing_mode)]))
+
+    dwis=[f.path for f in layout.get(subject=subject_label,
+                                                   suffix='dwi',
+                                                   extensions=["nii.gz", "nii"],**sessions)]
+                                                   
+    
+    pos = []; neg = []
+    PEdir = None; echospacing = None
+    dwi_jsonfile=None
+    
+    for idx,dwi in enumerate(dwis):
+        metadata = layout.get_metadata(dwi)
+        
+        #get metadata json file path so we can pass it to the eddy command
+        dwi_file_entities=layout.parse_file_entities(dwi)
+        dwi_file_entities['extension']='json'
+        try:
+            metadata_jsonfile=layout.get(**dwi_file_entities)
+            if len(metadata_jsonfile)>0:
+                dwi_jsonfile=metadata_jsonfile[0].path
+        except:
+            pass
         
-        diff_stages_dict = OrderedDict([("DiffusionPreprocessing", partial(run_diffusion_processsing,
-                                                 path=args.output_dir,
-                                                 subject="sub-%s"%subject_label,
-                                                 posData=posdata,
-                                                 negData=negdata,
-                                                 echospacing=echospacing,
-                                                 n_cpus=args.n_cpus,
-                                                 PEdir=PEdir,
-                                                 gdcoeffs=args.gdcoeffs,
-                                                 dwiname=args.diffusion_output_name,
-                                                 eddy_no_gpu=args.diffusion_eddy_no_gpu,
-                                                 extra_eddy_args=args.diffusion_eddy_args))
-                       ])
-                       
-        for stage, stage_diff in diff_stages_dict.items():
-            if stage in args.stages:
-                print(f"{stage} {dwis}.")
-                stage_diff()
-                
-        diff_substages_dict = OrderedDict([("DiffusionPreprocessing_PreEddy", partial(run_diffusion_processsing_preeddy,
-                                                 path=args.output_dir,
-                                                 subject="sub-%s"%subject_label,
-                                                 posData=posdata,
-                                                 negData=negdata,
-                                                 echospacing=echospacing,
-                                                 n_cpus=args.n_cpus,
-                                                 PEdir=PEdir,
-                                                 dwiname=args.diffusion_output_name)),
-                                        ("DiffusionPreprocessing_Eddy", partial(run_diffusion_processsing_eddy,
-                                                 path=args.output_dir,
-                                                 subject="sub-%s"%subject_label,
-                                                 n_cpus=args.n_cpus,
-                                                 dwiname=args.diffusion_output_name,
-                                                 eddy_no_gpu=args.diffusion_eddy_no_gpu,
-                                                 extra_eddy_args=args.diffusion_eddy_args)),
-                                        ("DiffusionPreprocessing_PostEddy", partial(run_diffusion_processsing_posteddy,
-                                                 path=args.output_dir,
-                                                 subject="sub-%s"%subject_label,
-                                                 n_cpus=args.n_cpus,
-                                                 dwiname=args.diffusion_output_name,
-                                                 gdcoeffs=args.gdcoeffs,
-                                                 user_matrix=args.diffusion_usermatrix))
-                       ])
+        # get phaseencodingdirection
+        phaseenc = metadata['PhaseEncodingDirection']
         
-        for stage, stage_diff in diff_substages_dict.items():
-            if stage in args.stages:
-                print(f"{stage} {dwis}.")
-                stage_diff()
+        acq = 1 if 'i' in phaseenc else 2
+        if not PEdir:
+            PEdir = acq
+        if PEdir != acq:
+            raise RuntimeError("Not all dwi images have the same encoding direction (both LR and AP). Not implemented.")
+        # get pos/neg
+        if "-" in phaseenc:
+            neg.append(dwi)
+        else:
+            pos.append(dwi)
+        # get echospacing
+        if not echospacing:
+            echospacing = metadata['EffectiveEchoSpacing']*1000.
+        if echospacing != metadata['EffectiveEchoSpacing']*1000.:
+            raise RuntimeError("Not all dwi images have the same echo spacing. Not implemented.")
+
+    extra_eddy_args = args.diffusion_eddy_args
+    if dwi_jsonfile:
+        extra_eddy_args += f" --json={dwi_jsonfile}"
+
+    plan["dwi"] = OrderedDict([("dwis", dwis),
+                               ("posData", "@".join(pos)),
+                               ("negData", "@".join(neg)),
+                               ("echospacing", echospacing),
+                               ("PEdir", PEdir),
+                               ("extra_eddy_args", extra_eddy_args)])
+    return plan
+
+def evict_intermediates(cache_dir, max_bytes, keep=None):
+    # least recently used first; a hit refreshes the mtime of a product. The
+    # product about to be used (keep) stays, even when it exceeds max_bytes
+    products = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and ".tmp" not in entry.name and entry.path != keep:
+            stat = entry.stat()
+            products.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in products) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(products):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def cached_intermediate(operation, params, inputs, suffix, produce):
+    # products are addressed by the operation, its parameters and the identity
+    # of its input files, so reruns and parallel jobs reuse them
+    cache_dir = os.path.join(args.output_dir, "tmp", "cache")
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    key = json.dumps({"operation": operation,
+                      "params": params,
+                      "inputs": [[f, os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in inputs]},
+                     sort_keys=True)
+    cache_file = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + suffix)
+    if os.path.exists(cache_file):
+        os.utime(cache_file)
+        return cache_file
+
+    tmp = cache_file[:-len(suffix)] + ".tmp%d_%d%s"%(os.getpid(), threading.get_ident(), suffix)
+    produce(tmp)
+    os.replace(tmp, cache_file)
+    evict_intermediates(cache_dir, args.intermediate_cache_mb * 1024 * 1024, keep=cache_file)
+    return cache_file
+
+def place_intermediate(cache_file, target):
+    if os.path.exists(target) and os.path.samefile(cache_file, target):
+        return
+    Path(os.path.dirname(target)).mkdir(parents=True, exist_ok=True)
+    tmp = "%s.tmp%d_%d"%(target, os.getpid(), threading.get_ident())
+    link_or_copy(cache_file, tmp)
+    os.replace(tmp, target)
+
+def prepare_subject(plan, stages=None):
+    # the few intermediate files the stages expect besides the BIDS inputs
+    if plan["anat"]["magnitudes"] and "PreFreeSurfer" in (stages or args.stages):
+        magnitudes = plan["anat"]["magnitudes"]
+        merged_file = cached_intermediate("fslmerge -t", [], magnitudes, ".nii.gz",
+                                          lambda out: run("fslmerge -t %s %s %s"%(out,
+                                                          magnitudes[0], magnitudes[1])))
+        place_intermediate(merged_file, plan["anat"]["fmap_args"]["fmapmag"])
+
+    def write_slicetiming(slicetiming, out):
+        with open(out, "w") as fp:
+            fp.writelines("%f\n" % t for t in slicetiming)
+
+    tmpdir = subject_tmp_dir(plan["subject"])
+    for bold in plan["bolds"]:
+        if bold["slicetiming"] is not None:
+            timing_file = cached_intermediate("slicetiming", bold["slicetiming"], [], ".txt",
+                                              partial(write_slicetiming, bold["slicetiming"]))
+            place_intermediate(timing_file, f"{tmpdir}/{bold['fmriname']}_st.txt")
+
+def image_voxels(path):
+    return int(np.prod(nifti_header(path)["shape"]))
+
+def subject_stage_graph(plan, n_cpus, path=None):
+    path = path or args.output_dir
+    subject = plan["subject"]
+    anat = plan["anat"]
+    t1_voxels = image_voxels(anat["t1ws"][0])
+    dwi_voxels = sum(image_voxels(dwi) for dwi in plan["dwi"]["dwis"]) or None
+    stage_graph = OrderedDict()
+    stage_graph["PreFreeSurfer"] = StageNode("PreFreeSurfer",
+                                             partial(run_pre_freesurfer,
+                                                     path=path,
+                                                     subject=subject,
+                                                     t1ws=anat["t1ws"],
+                                                     t2ws=anat["t2ws"],
+                                                     n_cpus=n_cpus,
+                                                     t1_template_res=anat["t1_template_res"],
+                                                     t2_template_res=anat["t2_template_res"],
+                                                     gdcoeffs=args.gdcoeffs,
+                                                     processing_mode=anat["processing_mode"],
+                                                     **anat["fmap_args"]),
+                                             [], f'PreFreeSurfer in {anat["processing_mode"]} mode',
+                                             input_voxels=t1_voxels)
+    stage_graph["FreeSurfer"] = StageNode("FreeSurfer",
+                                          partial(run_freesurfer,
+                                                  path=path,
+                                                  subject=subject,
+                                                  n_cpus=n_cpus,
+                                                  fs_templates=args.fs_templates,
+                                                  processing_mode=anat["processing_mode"]),
+                                          ["PreFreeSurfer"], f'FreeSurfer in {anat["processing_mode"]} mode',
+                                          input_voxels=t1_voxels)
+    stage_graph["PostFreeSurfer"] = StageNode("PostFreeSurfer",
+                                              partial(run_post_freesurfer,
+                                                      path=path,
+                                                      subject=subject,
+                                                      grayordinatesres=grayordinatesres,
+                                                      lowresmesh=lowresmesh,
+                                                      n_cpus=n_cpus,
+                                                      regname=args.coreg,
+                                                      processing_mode=anat["processing_mode"]),
+                                              ["FreeSurfer"], f'PostFreeSurfer in {anat["processing_mode"]} mode',
+                                              input_voxels=t1_voxels)
+
+    for bold in plan["bolds"]:
+        volume_node = f"fMRIVolume_{bold['fmriname']}"
+        message = f"Processing {bold['fmritcs']} in {bold['processing_mode']} mode."
+        stage_graph[volume_node] = StageNode("fMRIVolume",
+                                             partial(run_generic_fMRI_volume_processsing,
+                                                     path=path,
+                                                     subject=subject,
+                                                     fmriname=bold["fmriname"],
+                                                     fmritcs=bold["fmritcs"],
+                                                     fmriscout=bold["fmriscout"],
+                                                     SEPhaseNeg=bold["SEPhaseNeg"],
+                                                     SEPhasePos=bold["SEPhasePos"],
+                                                     echospacing=bold["echospacing"],
+                                                     unwarpdir=bold["unwarpdir"],
+                                                     fmrires=bold["fmrires"],
+                                                     dcmethod=bold["dcmethod"],
+                                                     biascorrection=bold["biascorrection"],
+                                                     n_cpus=n_cpus,
+                                                     gdcoeffs=args.gdcoeffs,
+                                                     doslicetime=bold["doslicetime"],
+                                                     slicetimerparams=bold["slicetimerparams"],
+                                                     processing_mode=bold["processing_mode"]),
+                                             ["PostFreeSurfer"], message, "bold", image_voxels(bold["fmritcs"]))
+        stage_graph[f"fMRISurface_{bold['fmriname']}"] = StageNode("fMRISurface",
+                                                                   partial(run_generic_fMRI_surface_processsing,
+                                                                           path=path,
+                                                                           subject=subject,
+                                                                           fmriname=bold["fmriname"],
+                                                                           fmrires=bold["fmrires"],
+                                                                           n_cpus=n_cpus,
+                                                                           grayordinatesres=grayordinatesres,
+                                                                           lowresmesh=lowresmesh,
+                                                                           regname=args.coreg),
+                                                                   [volume_node], message, "bold",
+                                                                   image_voxels(bold["fmritcs"]))
+
+    dwi = plan["dwi"]
+    # the diffusion chain only needs the structural outputs for the final
+    # registration to T1w (PostEddy), so PreEddy/Eddy can overlap with FreeSurfer.
+    # The sub-stages share their outputs with the monolithic stage and must not
+    # run alongside it when both are selected.
+    monolithic_diffusion = [stage for stage in ["DiffusionPreprocessing"] if stage in args.stages]
+    stage_graph["DiffusionPreprocessing"] = StageNode("DiffusionPreprocessing",
+                                                      partial(run_diffusion_processsing,
+                                                              path=path,
+                                                              subject=subject,
+                                                              posData=dwi["posData"],
+                                                              negData=dwi["negData"],
+                                                              echospacing=dwi["echospacing"],
+                                                              n_cpus=n_cpus,
+                                                              PEdir=dwi["PEdir"],
+                                                              gdcoeffs=args.gdcoeffs,
+                                                              dwiname=args.diffusion_output_name,
+                                                              eddy_no_gpu=args.diffusion_eddy_no_gpu,
+                                                              extra_eddy_args=dwi["extra_eddy_args"]),
+                                                      ["PostFreeSurfer"], f"DiffusionPreprocessing {dwi['dwis']}.",
+                                                      input_voxels=dwi_voxels)
+    stage_graph["DiffusionPreprocessing_PreEddy"] = StageNode("DiffusionPreprocessing_PreEddy",
+                                                              partial(run_diffusion_processsing_preeddy,
+                                                                      path=path,
+                                                                      subject=subject,
+                                                                      posData=dwi["posData"],
+                                                                      negData=dwi["negData"],
+                                                                      echospacing=dwi["echospacing"],
+                                                                      n_cpus=n_cpus,
+                                                                      PEdir=dwi["PEdir"],
+                                                                      dwiname=args.diffusion_output_name),
+                                                              monolithic_diffusion,
+                                                              f"DiffusionPreprocessing_PreEddy {dwi['dwis']}.",
+                                                              input_voxels=dwi_voxels)
+    stage_graph["DiffusionPreprocessing_Eddy"] = StageNode("DiffusionPreprocessing_Eddy",
+                                                           partial(run_diffusion_processsing_eddy,
+                                                                   path=path,
+                                                                   subject=subject,
+                                                                   n_cpus=n_cpus,
+                                                                   dwiname=args.diffusion_output_name,
+                                                                   eddy_no_gpu=args.diffusion_eddy_no_gpu,
+                                                                   extra_eddy_args=dwi["extra_eddy_args"]),
+                                                           ["DiffusionPreprocessing_PreEddy"],
+                                                           f"DiffusionPreprocessing_Eddy {dwi['dwis']}.",
+                                                           input_voxels=dwi_voxels)
+    stage_graph["DiffusionPreprocessing_PostEddy"] = StageNode("DiffusionPreprocessing_PostEddy",
+                                                               partial(run_diffusion_processsing_posteddy,
+                                                                       path=path,
+                                                                       subject=subject,
+                                                                       n_cpus=n_cpus,
+                                                                       dwiname=args.diffusion_output_name,
+                                                                       gdcoeffs=args.gdcoeffs,
+                                                                       user_matrix=args.diffusion_usermatrix),
+                                                               ["DiffusionPreprocessing_Eddy", "PostFreeSurfer"],
+                                                               f"DiffusionPreprocessing_PostEddy {dwi['dwis']}.",
+                                                               input_voxels=dwi_voxels)
+    return stage_graph
+
+# working directories of PreFreeSurfer in T1w/ and T2w/
+structural_scratch = ["ACPCAlignment", "BrainExtraction_FNIRTbased", "BiasFieldCorrection_sqrtT1wXT1w",
+                      "T2wToT1wDistortionCorrectAndReg", "T2wToT1wReg", "*_GradientDistortionUnwarp"]
+
+def retention_rules(plan, path):
+    # intermediates that can be removed: the --keep levels removing them, a
+    # glob, the nodes that must have completed first ("|" separates
+    # alternatives) and the node whose completion record lists the removal
+    subject_dir = os.path.join(path, plan["subject"])
+    tmpdir = subject_tmp_dir(plan["subject"])
+    structural = ["PreFreeSurfer", "FreeSurfer", "PostFreeSurfer"]
+    both = ["standard", "minimal"]
+    rules = [(both, os.path.join(subject_dir, anat_dir, scratch), structural, "PreFreeSurfer")
+             for anat_dir in ["T1w", "T2w"] for scratch in structural_scratch]
+    rules += [(["minimal"], os.path.join(subject_dir, "T2w"), structural, "PreFreeSurfer"),
+              (both, os.path.join(tmpdir, "magfile.nii.gz"), ["PreFreeSurfer"], "PreFreeSurfer")]
+    for bold in plan["bolds"]:
+        volume_node = f"fMRIVolume_{bold['fmriname']}"
+        bold_nodes = [volume_node, f"fMRISurface_{bold['fmriname']}"]
+        rules += [(both, os.path.join(subject_dir, bold["fmriname"], "OneStepResampling"), bold_nodes, volume_node),
+                  (["minimal"], os.path.join(subject_dir, bold["fmriname"]), bold_nodes, volume_node),
+                  (both, os.path.join(tmpdir, bold["fmriname"] + "_st.txt"), [volume_node], volume_node)]
+    diffusion = "DiffusionPreprocessing|DiffusionPreprocessing_PostEddy"
+    diffusion_dir = os.path.join(subject_dir, args.diffusion_output_name)
+    rules += [(both, os.path.join(diffusion_dir, "rawdata"), [diffusion], diffusion),
+              (both, os.path.join(diffusion_dir, "topup"), [diffusion], diffusion),
+              (["minimal"], diffusion_dir, [diffusion], diffusion)]
+    return rules
+
+def tree_size(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    return sum(os.lstat(os.path.join(root, name)).st_size
+               for root, dirs, files in os.walk(path) for name in files)
+
+def prune_intermediates(plan, path, keep):
+    # removes the intermediates of stages whose consumers all completed; what
+    # was removed is added to the completion record of the producing stage, so
+    # the stage is still recognised as complete
+    if keep == "all":
+        return
+    subject = plan["subject"]
+    def completed(alternatives):
+        return next((node for node in alternatives.split("|")
+                     if read_checkpoint(checkpoint_file(path, subject, node))), None)
+
+    freed = 0
+    for levels, pattern, consumers, owner in retention_rules(plan, path):
+        if keep not in levels or not all(completed(consumer) for consumer in consumers):
+            continue
+        targets = glob(pattern)
+        if not targets:
+            continue
+        record_file = checkpoint_file(path, subject, completed(owner))
+        record = read_checkpoint(record_file)
+        pruned = record.setdefault("pruned", [])
+        for target in targets:
+            size = tree_size(target)
+            if os.path.isdir(target) and not os.path.islink(target):
+                rmtree(target)
+            else:
+                os.remove(target)
+            freed += size
+            # relative to the output directory, which a --work_dir mirrors
+            relative = os.path.relpath(target, path if target.startswith(path + os.sep) else args.output_dir)
+            if relative not in [entry["path"] for entry in pruned]:
+                pruned.append({"path": relative, "bytes": size, "keep": keep,
+                               "pruned": datetime.datetime.now().isoformat()})
+            forget_manifest_paths(path, subject, relative)
+        write_checkpoint(record_file, record)
+    if freed:
+        print(f"BIDS App wrapper: removed {freed / 1024.0 ** 3:.2f} GB of intermediates of {subject} "
+              f"(--keep {keep})")
+
+def write_plan(plan):
+    plan_file = os.path.join(args.output_dir, "plans", plan["subject"] + ".json")
+    Path(os.path.dirname(plan_file)).mkdir(parents=True, exist_ok=True)
+    with open(plan_file, "w") as fp:
+        json.dump(plan, fp, indent=2)
+    print(f"BIDS App wrapper: wrote processing plan of {plan['subject']} to {plan_file}")
+
+# rough runtime (s) of a stage, used for the resource hints of a job manifest
+# until the stage has been profiled on this dataset
+stage_runtime_defaults = {"PreFreeSurfer": 2 * 3600,
+                          "FreeSurfer": 8 * 3600,
+                          "PostFreeSurfer": 2 * 3600,
+                          "fMRIVolume": 2 * 3600,
+                          "fMRISurface": 1800,
+                          "DiffusionPreprocessing": 6 * 3600,
+                          "DiffusionPreprocessing_PreEddy": 1800,
+                          "DiffusionPreprocessing_Eddy": 4 * 3600,
+                          "DiffusionPreprocessing_PostEddy": 1800}
+
+# rough peak memory (GB) of a stage for HCP-style inputs of the given number of
+# voxels (times timepoints): 0.7mm T1w, 2mm multiband BOLD and 1.25mm dMRI.
+# Estimates scale linearly with the input size of a stage
+stage_memory_model = {"PreFreeSurfer": (8, 260 * 311 * 260),
+                      "FreeSurfer": (8, 260 * 311 * 260),
+                      "PostFreeSurfer": (8, 260 * 311 * 260),
+                      "fMRIVolume": (12, 104 * 90 * 72 * 1200),
+                      "fMRISurface": (4, 104 * 90 * 72 * 1200),
+                      "DiffusionPreprocessing": (16, 145 * 174 * 145 * 288),
+                      "DiffusionPreprocessing_PreEddy": (8, 145 * 174 * 145 * 288),
+                      "DiffusionPreprocessing_Eddy": (16, 145 * 174 * 145 * 288),
+                      "DiffusionPreprocessing_PostEddy": (8, 145 * 174 * 145 * 288)}
+
+def measured_stage_usage(output_dir):
+    # the resource usage of earlier runs, by stage (fMRI runs are pooled)
+    measured = {}
+    for usage_file in glob(os.path.join(output_dir, "profiling", "*_resource_usage.jsonl")):
+        with open(usage_file) as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("returncode") != 0:
+                    continue
+                measured.setdefault(pooled_stage(record["stage"], record.get("run")), []).append(record)
+    return measured
+
+def stage_memory_gb(stage, input_voxels, measured):
+    # measured peak memory takes precedence over the model, per voxel of input
+    # where known, otherwise the largest seen so far; with a 20% margin. The
+    # peak of the whole stage where recorded, older records only have that
+    # of its largest process
+    def peak_kb(record):
+        return record.get("tree_max_rss_kb") or record.get("max_rss_kb")
+    records = [r for r in measured.get(stage, []) if peak_kb(r)]
+    scalable = [r for r in records if r.get("input_voxels")]
+    if input_voxels and scalable:
+        mem_gb = input_voxels * max(peak_kb(r) / r["input_voxels"] for r in scalable) / 1024.0 ** 2
+    elif records:
+        mem_gb = max(peak_kb(r) for r in records) / 1024.0 ** 2
+    else:
+        mem_gb, reference_voxels = stage_memory_model.get(stage, (8, None))
+        if input_voxels and reference_voxels:
+            mem_gb *= float(input_voxels) / reference_voxels
+    return max(1.0, mem_gb * 1.2)
+
+def stage_resources(stage, n_cpus, input_voxels, measured, history):
+    runtime_s = estimate_runtime_s(stage, n_cpus, input_voxels, history.get(stage) or measured.get(stage))
+    return OrderedDict([("cores", n_cpus),
+                        ("mem_gb", int(np.ceil(stage_memory_gb(stage, input_voxels, measured)))),
+                        ("expected_runtime_s", int(runtime_s))])
+
+def job_manifest_file():
+    return os.path.join(args.output_dir, "jobs", "manifest.json")
+
+# plans made by the preflight, used instead of planning a unit once more
+unit_plans = {}
+
+def unit_plan(subject_label, session_label=None):
+    plan = unit_plans.get((subject_label, session_label))
+    return plan or plan_subject(subject_label, subject_layout(subject_label), session_label)
+
+def plan_problems(plan):
+    # what would make the selected stages of a planned unit fail later on
+    problems = []
+    # exported jobs merge them on the execution host
+    if (plan["anat"]["magnitudes"] and "PreFreeSurfer" in args.stages and not args.export_jobs
+            and not shutil.which("fslmerge")):
+        problems.append("fslmerge is not on the PATH, it is needed to merge the fieldmap magnitude images")
+    diffusion_stages = [stage for stage in args.stages if stage.startswith("DiffusionPreprocessing")]
+    if diffusion_stages and not plan["dwi"]["dwis"]:
+        problems.append(f"no dwi images for {', '.join(diffusion_stages)}")
+    elif diffusion_stages and not (plan["dwi"]["posData"] and plan["dwi"]["negData"]):
+        problems.append("DiffusionPreprocessing needs dwi images of both phase encoding polarities")
+    return problems
+
+def describe_error(e):
+    # a missing metadata field is a bare KeyError, the failing line names it
+    frame = traceback.extract_tb(e.__traceback__)[-1]
+    return f"{type(e).__name__}: {e} (run.py line {frame.lineno}: {frame.line})"
+
+def preflight_subject(subject_label, session_labels):
+    try:
+        layout = subject_layout(subject_label)
+    except Exception as e:
+        return [((subject_label, ses), None, ["indexing failed: " + describe_error(e)]) for ses in session_labels]
+    results = []
+    for session_label in session_labels:
+        try:
+            plan = plan_subject(subject_label, layout, session_label)
+            results.append(((subject_label, session_label), plan, plan_problems(plan)))
+        except Exception as e:
+            results.append(((subject_label, session_label), None, [describe_error(e)]))
+    return results
+
+def preflight(units, max_workers=8):
+    # plans every unit in parallel before any stage is started, so that
+    # metadata errors show up at once instead of hours into a run; returns the
+    # units that passed and the ones that did not
+    if args.gdcoeffs != "NONE" and not os.path.exists(args.gdcoeffs):
+        raise Exception("--gdcoeffs %s does not exist"%args.gdcoeffs)
+    sessions = OrderedDict()
+    for subject_label, session_label in units:
+        sessions.setdefault(subject_label, []).append(session_label)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(sessions) or 1)) as executor:
+        results = [result for subject_results in executor.map(preflight_subject, sessions, sessions.values())
+                   for result in subject_results]
+
+    passed, failed, report = [], [], []
+    for unit, plan, problems in results:
+        report.append(OrderedDict([("subject", unit_subject(*unit)),
+                                   ("passed", not problems),
+                                   ("problems", problems)]))
+        if problems:
+            failed.append(unit)
+            for problem in problems:
+                print(f"BIDS App wrapper: preflight: {unit_subject(*unit)}: {problem}")
+        else:
+            passed.append(unit)
+            unit_plans[unit] = plan
+    report_file = os.path.join(args.output_dir, "preflight", "report.json")
+    Path(os.path.dirname(report_file)).mkdir(parents=True, exist_ok=True)
+    with open(report_file + ".tmp", "w") as fp:
+        json.dump({"checked": datetime.datetime.now().isoformat(),
+                   "stages": args.stages,
+                   "subjects": report}, fp, indent=2)
+    os.replace(report_file + ".tmp", report_file)
+    print(f"BIDS App wrapper: preflight: {len(passed)} of {len(units)} subjects passed, "
+          f"report in {report_file}")
+    return passed, failed
+
+def export_jobs(units):
+    # one job per selected stage node, in an order that respects the
+    # dependencies, so that it can also serve as array job indices
+    measured = measured_stage_usage(args.output_dir)
+    history = runtime_history()
+    jobs = []
+    plans = OrderedDict()
+    for subject_label, session_label in units:
+        plan = unit_plan(subject_label, session_label)
+        # the intermediates are prepared by the jobs, see execute_job
+        plans[plan["subject"]] = plan
+        stage_graph = subject_stage_graph(plan, args.n_cpus)
+        for node, stage_node in stage_graph.items():
+            if stage_node.stage not in args.stages:
+                continue
+            dry_run = stage_node.func(stage_id=node, dry_run=True)
+            jobs.append(OrderedDict([("id", f"{plan['subject']}_{node}"),
+                                     ("index", len(jobs)),
+                                     ("subject", plan["subject"]),
+                                     ("stage", stage_node.stage),
+                                     ("node", node),
+                                     ("depends", [f"{plan['subject']}_{dep}" for dep in
+                                                  sorted(selected_depends(stage_graph, node))]),
+                                     ("stage_depends", sorted(all_depends(stage_graph, node))),
+                                     ("resources", stage_resources(stage_node.stage,
+                                                                   stage_node.func.keywords["n_cpus"],
+                                                                   stage_node.input_voxels,
+                                                                   measured, history)),
+                                     ("function", stage_node.func.func.__name__),
+                                     ("arguments", dict(stage_node.func.keywords,
+                                                        input_voxels=stage_node.input_voxels)),
+                                     ("message", stage_node.message),
+                                     ("command", dry_run["command"]),
+                                     ("env", dry_run["env"])]))
+
+    manifest_file = job_manifest_file()
+    Path(os.path.dirname(manifest_file)).mkdir(parents=True, exist_ok=True)
+    with open(manifest_file + ".tmp", "w") as fp:
+        json.dump({"bids_dir": os.path.abspath(args.bids_dir),
+                   "output_dir": os.path.abspath(args.output_dir),
+                   "hcp_pipelines_version": hcp_pipelines_version(),
+                   "plans": plans,
+                   "jobs": jobs}, fp, indent=2)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    # a flat table for batch systems that take one line per job
+    tsv_file = re.sub(r"\.json$", ".tsv", manifest_file)
+    with open(tsv_file, "w") as fp:
+        fp.write("index\tid\tdepends\tcores\tmem_gb\texpected_runtime_s\n")
+        for job in jobs:
+            fp.write("%d\t%s\t%s\t%d\t%d\t%d\n"%(job["index"], job["id"], ",".join(job["depends"]) or "NONE",
+                                                 job["resources"]["cores"], job["resources"]["mem_gb"],
+                                                 job["resources"]["expected_runtime_s"]))
+    print(f"BIDS App wrapper: wrote {len(jobs)} jobs to {manifest_file} and {tsv_file}; "
+          "run each of them with --execute_job <id or index>")
+
+def execute_job(job_ref):
+    with open(job_manifest_file()) as fp:
+        manifest = json.load(fp)
+    jobs = manifest["jobs"]
+    job = next((job for job in jobs if job_ref in (job["id"], str(job["index"]))), None)
+    if job is None:
+        raise Exception("No job %s in %s"%(job_ref, job_manifest_file()))
+    # the batch system is expected to enforce the order, but a job started
+    # too early would silently work on missing or stale inputs
+    for dep in job["depends"]:
+        dep_node = dep[len(job["subject"]) + 1:]
+        if read_checkpoint(checkpoint_file(job["arguments"]["path"], job["subject"], dep_node)) is None:
+            raise Exception("Job %s depends on %s, which has not completed"%(job["id"], dep))
+    # on the execution host, which has the tools (fslmerge) the submit host may lack
+    prepare_subject(manifest["plans"][job["subject"]], [job["stage"]])
+    print(job["message"])
+    force_stage = bool({"all", job["node"], job["stage"]}.intersection(args.force_stages))
+    run_with_retries(partial(globals()[job["function"]], **job["arguments"]), job["stage"],
+                     stage_id=job["node"],
+                     stage_depends=job["stage_depends"],
+                     force_stage=force_stage)
+
+def process_subject(subject_label, n_cpus, mem_gb=None, session_label=None):
+    plan = unit_plan(subject_label, session_label)
+    if args.plan_only:
+        write_plan(plan)
+        return
+
+    prepare_subject(plan)
+    n_bold_workers = max(1, min(args.max_parallel_bolds, len(plan["bolds"])))
+    max_parallel_stages = args.max_parallel_stages or n_bold_workers
+    if not args.work_dir:
+        try:
+            run_stage_graph(subject_stage_graph(plan, n_cpus), max_parallel_stages, {"bold": n_bold_workers},
+                            mem_gb)
+        finally:
+            prune_intermediates(plan, args.output_dir, args.keep)
+        return
+
+    staged = StagedOutputs(plan["subject"], args.work_dir, args.output_dir, args.write_back_mb_per_s)
+    staged.stage_in()
+    success = False
+    try:
+        run_stage_graph(subject_stage_graph(plan, n_cpus, staged.work_path), max_parallel_stages,
+                        {"bold": n_bold_workers}, mem_gb)
+        success = True
+    finally:
+        # pruned before copying back, and once more in the output directory
+        # for the earlier outputs that were staged in
+        prune_intermediates(plan, staged.work_path, args.keep)
+        staged.finish(success)
+        prune_intermediates(plan, args.output_dir, args.keep)
+
+def run_subject_logged(subject_label, session_label, n_cpus, mem_gb, log_file):
+    # runs inside a worker process; everything it prints goes to the subject's log
+    with open(log_file, "a", buffering=1) as log:
+        sys.stdout = log
+        sys.stderr = log
+        try:
+            process_subject(subject_label, n_cpus, mem_gb, session_label)
+        except Exception:
+            traceback.print_exc()
+            raise
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+
+def pin_subject_worker(slot_counter, n_workers):
+    # every participant worker process gets its own share of the cores
+    global cpu_allocator
+    with slot_counter.get_lock():
+        slot = slot_counter.value
+        slot_counter.value += 1
+    cpus = numa_ordered(cpu_allocator.free)
+    share = max(1, len(cpus) // n_workers)
+    cpu_allocator = CpuAllocator(cpus[slot * share:(slot + 1) * share] or cpus)
+
+def run_subjects_parallel(units, max_workers):
+    # units are (participant, session) pairs, the session is None unless
+    # sessions are processed on their own
+    max_workers = min(max_workers, len(units))
+    subject_n_cpus = max(1, args.n_cpus // max_workers)
+    subject_mem_gb = args.mem_gb / max_workers if args.mem_gb else None
+    log_dir = os.path.join(args.output_dir, "logs")
+    Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    failed = []
+    context = multiprocessing.get_context("fork")
+    worker_setup = {}
+    if cpu_allocator:
+        worker_setup = {"initializer": pin_subject_worker,
+                        "initargs": (context.Value("i", 0), max_workers)}
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, **worker_setup) as executor:
+        futures = {}
+        for subject_label, session_label in units:
+            subject = unit_subject(subject_label, session_label)
+            log_file = os.path.join(log_dir, f"{subject}.log")
+            print(f"Processing {subject} with {subject_n_cpus} CPUs, logging to {log_file}")
+            futures[executor.submit(run_subject_logged, subject_label, session_label,
+                                    subject_n_cpus, subject_mem_gb, log_file)] = subject
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print(f"{futures[future]} finished")
+            except Exception as e:
+                print(f"BIDS App wrapper: processing of {futures[future]} failed: {e}")
+                failed.append(futures[future])
+    if failed:
+        raise Exception("Processing failed for %d of %d subjects: %s"%(len(failed),
+                        len(units), ", ".join(sorted(failed))))
+
+def queue_connection(queue_file):
+    # autocommit, transactions are started explicitly where jobs are claimed
+    connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                       "id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT NOT NULL, "
+                       "stages TEXT NOT NULL, status TEXT NOT NULL, worker TEXT, "
+                       "queued TEXT, started TEXT, finished TEXT, error TEXT, session TEXT)")
+    # queues created before sessions could be processed on their own
+    if "session" not in [column[1] for column in connection.execute("PRAGMA table_info(jobs)")]:
+        connection.execute("ALTER TABLE jobs ADD COLUMN session TEXT")
+    return connection
+
+def enqueue_subjects(queue_file, units, stages):
+    now = datetime.datetime.now().isoformat()
+    with closing(queue_connection(queue_file)) as connection:
+        connection.executemany("INSERT INTO jobs (subject, session, stages, status, queued) "
+                               "VALUES (?, ?, ?, 'queued', ?)",
+                               [(label, session, json.dumps(stages), now) for label, session in units])
+    print(f"BIDS App wrapper: queued {len(units)} job(s) in {queue_file}")
+
+def claim_job(queue_file, worker_id):
+    with closing(queue_connection(queue_file)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        job = connection.execute("SELECT id, subject, session, stages FROM jobs WHERE status = 'queued' "
+                                 "ORDER BY id LIMIT 1").fetchone()
+        if job:
+            connection.execute("UPDATE jobs SET status = 'running', worker = ?, started = ? WHERE id = ?",
+                               (worker_id, datetime.datetime.now().isoformat(), job[0]))
+        connection.execute("COMMIT")
+    return job
+
+def finish_job(queue_file, job_id, error=None):
+    with closing(queue_connection(queue_file)) as connection:
+        connection.execute("UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?",
+                           ("failed" if error else "done", datetime.datetime.now().isoformat(),
+                            error, job_id))
+
+def requeue_abandoned_jobs(queue_file):
+    # jobs of workers on this host that no longer exist are queued again
+    host = socket.gethostname()
+    with closing(queue_connection(queue_file)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        for job_id, worker in connection.execute("SELECT id, worker FROM jobs WHERE status = 'running'").fetchall():
+            worker_host, _, pid = worker.rpartition(":")
+            if worker_host == host and not os.path.exists(f"/proc/{pid}"):
+                print(f"BIDS App wrapper: requeuing job {job_id} of worker {worker}, which is gone")
+                connection.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ?", (job_id,))
+        connection.execute("COMMIT")
+
+def run_worker(queue_file, idle_timeout, poll_interval=5):
+    worker_id = "%s:%d"%(socket.gethostname(), os.getpid())
+    requeue_abandoned_jobs(queue_file)
+    print(f"BIDS App wrapper: worker {worker_id} waiting for jobs in {queue_file}")
+    default_stages = args.stages
+    idle_since = time.time()
+    while True:
+        job = claim_job(queue_file, worker_id)
+        if job is None:
+            if idle_timeout and time.time() - idle_since > idle_timeout:
+                print(f"BIDS App wrapper: no jobs for {idle_timeout:g}s, worker {worker_id} exits")
+                return
+            time.sleep(poll_interval)
+            continue
+
+        job_id, subject_label, session_label, stages = job
+        subject = unit_subject(subject_label, session_label)
+        print(f"BIDS App wrapper: job {job_id}: processing {subject}")
+        args.stages = json.loads(stages)
+        try:
+            if not args.skip_bids_validation:
+                validate_bids([subject_label])
+            process_subject(subject_label, args.n_cpus, args.mem_gb, session_label)
+            finish_job(queue_file, job_id)
+            print(f"BIDS App wrapper: job {job_id}: {subject} finished")
+        except Exception as e:
+            traceback.print_exc()
+            finish_job(queue_file, job_id, str(e))
+        finally:
+            args.stages = default_stages
+        idle_since = time.time()
+
+__version__ = open('/version').read() if os.path.exists('/version') else "unknown"
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='HCP Pipelines BIDS App (T1w, T2w, fMRI)')
+    parser.add_argument('bids_dir', help='The directory with the input dataset '
+                        'formatted according to the BIDS standard.')
+    parser.add_argument('output_dir', help='The directory where the output files '
+                        'should be stored. If you are running group level analysis '
+                        'this folder should be prepopulated with the results of the'
+                        'participant level analysis.')
+    parser.add_argument('analysis_level', help='Level of the analysis that will be performed. '
+                        'Multiple participant level analyses can be run independently '
+                        '(in parallel) using the same output_dir.',
+                        choices=['participant'])
+    parser.add_argument('--participant_label', help='The label of the participant that should be analyzed. The label '
+                       'corresponds to sub-<participant_label> from the BIDS spec '
+                       '(so it does not include "sub-"). If this parameter is not '
+                       'provided all subjects should be analyzed. Multiple '
+                       'participants can be specified with a space separated list.',
+                       nargs="+")
+    parser.add_argument('--session_label', help='The label of the session that should be analyzed. The label '
+                       'corresponds to ses-<session_label> from the BIDS spec '
+                       '(so it does not include "ses-"). If this parameter is not '
+                       'provided, all sessions should be analyzed. Multiple '
+                       'sessions can be specified with a space separated list.',
+                       nargs="+")
+    parser.add_argument('--n_cpus', help='Number of CPUs/cores available to use.',
+                       default=1, type=int)
+    parser.add_argument('--plan_only', action='store_true', default=False,
+                       help='Only resolve the inputs and acquisition parameters of every '
+                            'participant and write them to <output_dir>/plans/sub-<label>.json '
+                            'without running any stage.')
+    parser.add_argument('--export_jobs', action='store_true', default=False,
+                        help='Instead of running the selected stages, write them as a job manifest with '
+                             'dependencies and resource hints to <output_dir>/jobs/manifest.json '
+                             '(and a manifest.tsv table), for submission to a batch system.')
+    parser.add_argument('--execute_job', help='Run a single job of <output_dir>/jobs/manifest.json, '
+                        'given by its id or index (e.g. $SLURM_ARRAY_TASK_ID).')
+    parser.add_argument('--mem_gb', help='Memory in GB available to the stages. A stage is only started '
+                        'when its estimated peak memory fits next to the stages already running. The '
+                        'estimates scale with the size of the input images and are refined by the peak '
+                        'memory measured in earlier runs (tree_max_rss_kb in <output_dir>/profiling: '
+                        'the summed resident memory of all processes of a stage, sampled every few '
+                        'seconds; max_rss_kb is that of its largest single process).', type=float)
+    parser.add_argument('--pin_cpus', action='store_true', default=False,
+                        help='Give every running stage its own set of --n_cpus cores (on a single '
+                             'NUMA node where possible) and pin the stage to them, so that concurrent '
+                             'stages and participants do not compete for the same cores.')
+    parser.add_argument('--max_parallel_subjects', help='Maximum number of participants to process '
+                       'concurrently in separate worker processes. --n_cpus is the total '
+                       'budget and is split evenly between the workers; each participant '
+                       'logs to <output_dir>/logs/sub-<participant_label>.log.',
+                       default=1, type=int)
+    parser.add_argument('--stage_timeout', nargs="+",
+                        help='Wall time limit in hours after which a stage is killed, for all stages '
+                             '(e.g. 48) and/or for single stages (e.g. PostFreeSurfer=6 '
+                             'DiffusionPreprocessing_Eddy=12). The stage fails and its dependent '
+                             'stages are not run.')
+    parser.add_argument('--stage_retries', nargs="+",
+                        help='Number of times a failed stage is retried, for all stages (e.g. 1) and/or '
+                             'for single stages (e.g. DiffusionPreprocessing_Eddy=2). A retry of eddy '
+                             'falls back to the CPU version (--no-gpu). DiffusionPreprocessing is run '
+                             'as its PreEddy, Eddy and PostEddy parts, so a retry or rerun resumes '
+                             'after the last completed part.')
+    parser.add_argument('--stage_retry_backoff', type=float, default=60,
+                        help='Seconds to wait before the first retry of a stage, doubled for every '
+                             'further retry.')
+    parser.add_argument('--stage_silence_timeout', type=float,
+                        help='Kill a stage that has not written any output for this many minutes, '
+                             'assuming that it hangs (e.g. a stalled MATLAB runtime).')
+    parser.add_argument('--per_session', action='store_true', default=False,
+                        help='Process every session of a participant on its own, as output subject '
+                             'sub-<participant_label>_ses-<session_label> with only the T1w/T2w, fMRI '
+                             'and dMRI of that session. Sessions are scheduled like participants, '
+                             'e.g. in parallel with --max_parallel_subjects. Participants without '
+                             'sessions are processed as usual.')
+    parser.add_argument('--per_session_shared_anat', action='store_true', default=False,
+                        help='With --per_session, use the T1w/T2w of all sessions of the participant '
+                             'for a session without T1w/T2w of its own, instead of failing it.')
+    parser.add_argument('--max_parallel_bolds', help='Maximum number of BOLD runs to process '
+                       'concurrently during fMRIVolume/fMRISurface. --n_cpus is split '
+                       'evenly between the concurrent runs.',
+                       default=1, type=int)
+    parser.add_argument('--max_parallel_stages', help='Maximum number of stages of a participant '
+                       'to run at the same time. Stages only start once the stages they '
+                       'depend on have finished, so e.g. diffusion preprocessing up to eddy '
+                       'can overlap with FreeSurfer. --n_cpus is split between the stages '
+                       'that can run at the same time. Defaults to --max_parallel_bolds.',
+                       default=None, type=int)
+    parser.add_argument('--stages', help='Which stages to run. Space separated list.',
+                       nargs="+", choices=['PreFreeSurfer', 'FreeSurfer',
+                                           'PostFreeSurfer', 'fMRIVolume',
+                                           'fMRISurface','DiffusionPreprocessing',
+                                           'DiffusionPreprocessing_PreEddy','DiffusionPreprocessing_Eddy','DiffusionPreprocessing_PostEddy'],
+                       default=['PreFreeSurfer', 'FreeSurfer', 'PostFreeSurfer',
+                                'fMRIVolume', 'fMRISurface'])
+    parser.add_argument('--stage_logs', help='Where the output of the HCP Pipelines stages goes: '
+                       'the console, or one log file per stage in <output_dir>/logs/sub-<label>/ '
+                       '(optionally gzip compressed). With log files only the last lines of a '
+                       'failing stage are printed.',
+                       choices=['console', 'file', 'gzip'], default='console')
+    parser.add_argument('--force_stages', help='Stages to rerun even though they completed before '
+                       'with the same command, inputs and HCP Pipelines version. Accepts stage '
+                       'names, single fMRI runs (e.g. fMRIVolume_task-rest_bold) or "all".',
+                       nargs="+", default=[])
+    parser.add_argument('--work_dir', help='Fast node-local directory in which the stages of each '
+                        'participant are run. Earlier outputs of the participant are copied there first, '
+                        'and outputs are copied back to output_dir in the background whenever a stage '
+                        'completed, and verified at the end.')
+    parser.add_argument('--write_back_mb_per_s', help='Bandwidth limit in MB/s for copying outputs '
+                        'back from --work_dir while stages are running (0 for no limit).',
+                        type=float, default=0)
+    parser.add_argument('--keep', help='Which intermediate files of the HCP Pipelines to keep. "standard" '
+                        'removes the working directories of PreFreeSurfer, the per-volume resampling of '
+                        'fMRIVolume, the raw data and topup copies of DiffusionPreprocessing and the '
+                        'files in <output_dir>/tmp; "minimal" also removes T2w/, the fMRI working '
+                        'directories and the diffusion working directory. Intermediates are only removed '
+                        'once all stages that use them completed.',
+                        choices=['minimal', 'standard', 'all'], default='all')
+    parser.add_argument('--fs_templates', help='How the FreeSurfer fsaverage and ?h.EC_average '
+                        'subjects are provided to each participant. "copy" copies them from '
+                        '$SUBJECTS_DIR into every participant; the other modes share a single '
+                        'read-only copy in <output_dir>/fs_templates through symbolic links, '
+                        'hard links or reflinks (falling back to copies where unsupported).',
+                        choices=['copy', 'symlink', 'hardlink', 'reflink'], default='copy')
+    parser.add_argument('--intermediate_cache_mb', help='Size limit in MB of the cache of small '
+                        'derived inputs (merged fieldmap magnitudes, slice timing files) in '
+                        '<output_dir>/tmp/cache. Least recently used entries are evicted first.',
+                        default=1024, type=int)
+    parser.add_argument('--coreg', help='Coregistration method to use',
+                        choices=['MSMSulc', 'FS'], default='MSMSulc')
+    parser.add_argument('--gdcoeffs', help='Path to gradients coefficients file',
+                        default="NONE")
+    parser.add_argument('--license_key', help='FreeSurfer license key - letters and numbers after "*" in the email you received after registration. To register (for free) visit https://surfer.nmr.mgh.harvard.edu/registration.html',
+                        required=True)
+    parser.add_argument('-v', '--version', action='version',
+                        version='HCP Pipelines BIDS App version {}'.format(__version__))
+    parser.add_argument('--anat_unwarpdir', help='Unwarp direction for 3D volumes',
+                        choices=['x', 'y', 'z', 'x-', 'y-', 'z-', 'NONE'], default="z")
+    parser.add_argument('--skip_bids_validation', '--skip-bids-validation', action='store_true',
+                        default=False,
+                        help='assume the input dataset is BIDS compliant and skip the validation')
+    parser.add_argument('--skip_preflight', action='store_true', default=False,
+                        help='Do not plan all subjects before processing starts. By default the '
+                             'acquisition parameters of every subject are checked first, in parallel, '
+                             'and subjects that would fail are reported in '
+                             '<output_dir>/preflight/report.json and not processed.')
+    parser.add_argument('--bids_database_dir', help='Directory for persistent per-participant BIDS '
+                        'index databases. An index is reused by later runs until directories '
+                        'or sidecars of that participant (or top level files) change.',
+                        default=None)
+    parser.add_argument('--bids_index_sessions_only', action='store_true', default=False,
+                        help='Only index the sessions given by --session_label. Anatomical '
+                             'images are then no longer taken from other sessions when the '
+                             'selected sessions have none.')
+    parser.add_argument('--processing_mode', '--processing-mode',
+                        choices=['hcp', 'legacy', 'auto'], default='hcp',
+                        help='Control HCP-Pipeline mode'
+                             'hcp (HCPStyleData): require T2w and fieldmap modalities'
+                             'legacy (LegacyStyleData): always ignore T2w and fieldmaps'
+                             'auto: use T2w and/or fieldmaps if available')
+    parser.add_argument('--doslicetime', help="Apply slice timing correction as part of fMRIVolume.",
+                        action='store_true', default=False)
+    parser.add_argument('--diffusion_output_name', help="Output base name for DiffusionPreprocessing.",
+                        default='Diffusion')
+    parser.add_argument('--diffusion_eddy_no_gpu', help="Do NOT use GPU version of eddy during DiffusionPreprocessing.",
+                        action='store_true', default=False)
+    parser.add_argument('--diffusion_eddy_args', help="String of extra args for eddy during DiffusionPreprocessing.",
+                        default='')
+    parser.add_argument('--diffusion_usermatrix', help="Matrix file to use instead of registering output to T1w.",
+                        default='')
+    parser.add_argument('--queue', help='SQLite job queue shared by --enqueue and --worker '
+                        '(default: <output_dir>/queue.sqlite). It should be on a local filesystem.')
+    parser.add_argument('--enqueue', action='store_true', default=False,
+                        help='Add the selected participants, with the selected --stages, as jobs to '
+                             'the --queue and exit.')
+    parser.add_argument('--worker', action='store_true', default=False,
+                        help='Run as a worker that keeps the BIDS indexes and caches in memory and '
+                             'processes jobs from the --queue one after the other. Several workers '
+                             'can share a queue.')
+    parser.add_argument('--output_manifest', action='store_true', default=False,
+                        help='After every stage, record the size, mtime and checksum (BLAKE2b) of the '
+                             'files of the subject in <output_dir>/manifests/<subject>.json, with the '
+                             'stage that wrote them. Only new and changed files are hashed. Completed '
+                             'stages whose outputs are missing or were modified are run again.')
+    parser.add_argument('--status', action='store_true', default=False,
+                        help='Print the progress and estimated completion time of the subjects being '
+                             'processed in output_dir and exit. Every subject rewrites its status in '
+                             '<output_dir>/status/<subject>.json while its stages run.')
+    parser.add_argument('--history_db', help='SQLite database recording every stage run (stage, input '
+                        'size, cores, duration), from which runtimes are estimated for --status and '
+                        'the resource hints of --export_jobs. Can be shared between datasets, and should be '
+                        'on a local filesystem. Default: hcppipelines_stage_history_<uid>.sqlite in the '
+                        'node-local temporary directory ($TMPDIR or /tmp). A locked or unavailable '
+                        'database is skipped with a message, it never fails a stage.')
+    parser.add_argument('--worker_idle_timeout', help='Seconds after which a --worker with an empty '
+                        'queue exits (0 to keep waiting for new jobs).', type=float, default=0)
+    return parser
+
+def configure(options):
+    # sets up the module for the given parsed options, also when run.py is
+    # imported, e.g. configure(get_parser().parse_args([...])); process_subject(...)
+    global args, session_to_analyze, cpu_allocator, stage_timeouts, stage_retries
+    args = options
+    # only use a subset of sessions
+    if args.session_label:
+        session_to_analyze = dict(session=args.session_label)
+    else:
+        session_to_analyze = dict()
+    if args.pin_cpus:
+        cpu_allocator = CpuAllocator(numa_ordered(os.sched_getaffinity(0))[:args.n_cpus])
+    stage_timeouts = parse_stage_settings("--stage_timeout", args.stage_timeout, float)
+    stage_retries = parse_stage_settings("--stage_retries", args.stage_retries, int)
+
+def subject_sessions(subject_labels):
+    # (participant, session) pairs of the sessions selected by --session_label;
+    # participants without sessions stay a single unit
+    units = []
+    for subject_label in subject_labels:
+        session_dirs = glob(os.path.join(args.bids_dir, f"sub-{subject_label}", "ses-*"))
+        session_labels = sorted(os.path.basename(d)[len("ses-"):] for d in session_dirs if os.path.isdir(d))
+        if args.session_label:
+            session_labels = [ses for ses in session_labels if ses in args.session_label]
+        units += [(subject_label, ses) for ses in session_labels] or [(subject_label, None)]
+    return units
+
+def main(argv=None):
+    global dataset_layout
+    configure(get_parser().parse_args(argv))
+    # the stages run in sessions of their own, which a Ctrl-C in the terminal
+    # or a closed terminal does not reach
+    for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(signum, terminate)
+
+    if (args.gdcoeffs != 'NONE') and ('PreFreeSurfer' in args.stages) and (args.anat_unwarpdir == "NONE"):
+        raise AssertionError('--anat_unwarpdir must be specified to use PreFreeSurfer distortion correction')
+
+    if args.status:
+        print_status()
+        return
+
+    # a job of an exported manifest needs neither validation nor an index
+    if args.execute_job is not None:
+        execute_job(args.execute_job)
+        return
+
+    queue_file = args.queue or os.path.join(args.output_dir, "queue.sqlite")
+    if args.worker:
+        run_worker(queue_file, args.worker_idle_timeout)
+        return
+
+    subjects_to_analyze = []
+    # only for a subset of subjects
+    if args.participant_label:
+        subjects_to_analyze = args.participant_label
+    # for all subjects
+    else:
+        subject_dirs = glob(os.path.join(args.bids_dir, "sub-*"))
+        subjects_to_analyze = [subject_dir.split("-")[-1] for subject_dir in subject_dirs]
+
+    # the units of work: every participant, or every session of a participant
+    units = [(subject_label, None) for subject_label in subjects_to_analyze]
+    if args.per_session:
+        units = subject_sessions(subjects_to_analyze)
+
+    if args.enqueue:
+        enqueue_subjects(queue_file, units, args.stages)
+        return
+
+    if not args.skip_bids_validation:
+        validate_bids(subjects_to_analyze)
+
+    # a single index of the whole dataset is only built when all participants are
+    # processed without a persistent index; otherwise every participant gets its own
+    dataset_layout = None
+    if not args.participant_label and not args.bids_database_dir:
+        dataset_layout = BIDSLayout(args.bids_dir, derivatives=False, absolute_paths=True)
+
+    # running participant level
+    if args.analysis_level == "participant":
+        # subjects that would fail are not started at all
+        failed_preflight = []
+        if not args.skip_preflight:
+            units, failed_preflight = preflight(units)
+        if args.export_jobs:
+            export_jobs(units)
+        elif args.max_parallel_subjects > 1 and len(units) > 1:
+            run_subjects_parallel(units, args.max_parallel_subjects)
+        else:
+            for subject_label, session_label in units:
+                process_subject(subject_label, args.n_cpus, args.mem_gb, session_label)
+        if failed_preflight:
+            raise Exception("Preflight failed for %d subject(s), which were not processed: %s"%(
+                            len(failed_preflight), ", ".join(unit_subject(*unit) for unit in failed_preflight)))
+
+if __name__ == "__main__":
+    main()